@@ -0,0 +1,85 @@
+import asyncio
+import random
+import sys
+from pathlib import Path
+
+# --- Configuration ---
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+SEED = 42
+
+sys.path.insert(0, str(BASE_DIR))
+
+from web.main import (  # noqa: E402
+    CATALOG_CODES, EXERCISE_COUNT_SCHEMA, SPLIT_CONFIGS, PREWARM_TOOL_SETS, TOKEN_BUDGET_MARGIN, TOKEN_BUDGET_SLACK,
+    TOKEN_BUDGET_WHITESPACE, TOKEN_COUNTER, WEEK_SCHEMA_CACHE, UserConfig, build_prompt, get_allowed_names, get_catalog_view,
+    get_user_config_from_model,
+)
+from web.token_budget import max_output_tokens, schema_token_budget  # noqa: E402
+
+ALL_TOOLS = PREWARM_TOOL_SETS[0]
+# (catalog encoding, output format) pairs
+ENCODINGS = [("json", "pairs"), ("compact", "pairs"), ("compact", "ids")]
+
+def label(encoding):
+    return f"{encoding[0]}/{encoding[1]}"
+
+async def measure(config, encoding):
+    """Prompt tokens, the longest output the schema accepts (with TOKEN_BUDGET_WHITESPACE tokens around
+    each separator) and its max_tokens budget for one configuration."""
+    catalog_encoding, output_format = encoding
+    user, min_ex, max_ex = get_user_config_from_model(config)
+    allowed_index = get_allowed_names()
+    catalog_view = get_catalog_view(user.level, user.gender)
+    split_config = next(c for c in SPLIT_CONFIGS[str(user.freq)] if c['id'] == config.split_id)
+    prompt = build_prompt(user, catalog_view.catalog, str(config.duration), min_ex, max_ex, split_config,
+                          allowed_names=allowed_index.raw, rng=random.Random(SEED), catalog_encoding=catalog_encoding,
+                          codes=CATALOG_CODES, output_format=output_format)
+    prepared = WEEK_SCHEMA_CACHE.get(user, split_config['days'], min_ex, max_ex, allowed_index, catalog_view, catalog_encoding, output_format)
+    exact = await TOKEN_COUNTER.fetch([prompt, *prepared.token_texts])
+    budget = schema_token_budget(prepared.schema, TOKEN_COUNTER, margin=TOKEN_BUDGET_MARGIN, slack=TOKEN_BUDGET_SLACK, whitespace=TOKEN_BUDGET_WHITESPACE)
+    return TOKEN_COUNTER.count(prompt), max_output_tokens(prepared.schema, TOKEN_COUNTER, whitespace=TOKEN_BUDGET_WHITESPACE), budget, exact
+
+async def run():
+    print(f"Token counter: {TOKEN_COUNTER.backend}")
+    print("Averaged over every level and gender, all tools selected\n")
+    totals = {encoding: [0.0, 0.0, 0] for encoding in ENCODINGS}
+    short_budgets = estimated = 0
+    for freq, split_options in SPLIT_CONFIGS.items():
+        for split_config in split_options:
+            results = {encoding: [] for encoding in ENCODINGS}
+            for level in EXERCISE_COUNT_SCHEMA:
+                for gender in ['M', 'F']:
+                    config = UserConfig(gender=gender, weight=70, level=level, freq=int(freq), duration=60,
+                                        intensity='Normal', split_id=split_config['id'], tools=list(ALL_TOOLS))
+                    for encoding in ENCODINGS:
+                        result = await measure(config, encoding)
+                        short_budgets += result[2] < result[1]
+                        estimated += not result[3]
+                        results[encoding].append(result)
+
+            print(f"[{freq} days / {split_config['id']}]")
+            for encoding in ENCODINGS:
+                prompt_tokens = sum(r[0] for r in results[encoding]) / len(results[encoding])
+                worst_output = sum(r[1] for r in results[encoding]) / len(results[encoding])
+                output_budget = sum(r[2] for r in results[encoding]) / len(results[encoding])
+                totals[encoding][0] += prompt_tokens
+                totals[encoding][1] += output_budget
+                totals[encoding][2] += 1
+                print(f"  {label(encoding)}: prompt tokens {prompt_tokens:.0f}, longest output {worst_output:.0f}, max_tokens {output_budget:.0f}")
+
+    print("\nMean across split configs:")
+    baseline_prompt, baseline_output, count = totals[ENCODINGS[0]]
+    for encoding in ENCODINGS:
+        prompt_tokens, output_budget, _ = totals[encoding]
+        print(f"  {label(encoding)}: prompt tokens {prompt_tokens / count:.0f} ({1 - prompt_tokens / baseline_prompt:.1%} fewer), "
+              f"output max_tokens {output_budget / count:.0f} ({1 - output_budget / baseline_output:.1%} fewer)")
+    print(f"\nConfigurations whose max_tokens is below the longest output: {short_budgets}")
+    if estimated:
+        print(f"{estimated} configurations used the estimate ({TOKEN_COUNTER.load_error}); start vLLM for the model tokenizer's counts")
+    await TOKEN_COUNTER.aclose()
+
+def main():
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
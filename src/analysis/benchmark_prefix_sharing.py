@@ -0,0 +1,103 @@
+import hashlib
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+# --- Configuration ---
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+NUM_REQUESTS = 2000
+SEED = 42
+BLOCK_SIZE = 16  # vLLM's default KV-cache block size, in tokens
+
+sys.path.insert(0, str(BASE_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from benchmark_schema_reuse import ALL_TOOLS, sample_configs  # noqa: E402
+from web.main import (  # noqa: E402
+    SPLIT_CONFIGS, build_prompt, get_allowed_names, get_catalog_view, get_user_config_from_model,
+)
+
+# Rough stand-in for the model tokenizer: words, single punctuation marks and whitespace runs
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]|\s+")
+
+class PrefixCacheStandIn:
+    """Local stand-in for vLLM's automatic prefix caching with an unbounded cache.
+
+    A prompt is cut into full blocks of BLOCK_SIZE tokens and each block is hashed together with
+    everything before it, so a block is only reused when the whole prefix up to it matches.
+    """
+
+    def __init__(self):
+        self.blocks = set()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def submit(self, prompt: str) -> int:
+        tokens = TOKEN_PATTERN.findall(prompt)
+        parent = b""
+        reused = 0
+        matching = True
+        for start in range(0, len(tokens) - BLOCK_SIZE + 1, BLOCK_SIZE):
+            block = "\x00".join(tokens[start:start + BLOCK_SIZE]).encode('utf-8')
+            parent = hashlib.sha256(parent + block).digest()
+            if matching and parent in self.blocks:
+                reused += BLOCK_SIZE
+            else:
+                matching = False
+                self.blocks.add(parent)
+        self.prompt_tokens += len(tokens)
+        self.cached_tokens += reused
+        return reused
+
+def all_tools_mix(n, rng):
+    """Every request keeps the default all-tools selection, as the web form submits it."""
+    configs = sample_configs(n, rng)
+    for config in configs:
+        config.tools = list(ALL_TOOLS)
+    return configs
+
+def custom_tools_mix(n, rng):
+    """Every request narrows the equipment to its own tool subset."""
+    configs = sample_configs(n, rng)
+    for config in configs:
+        config.tools = rng.sample(ALL_TOOLS, rng.randint(3, len(ALL_TOOLS)))
+    return configs
+
+REQUEST_MIXES = [
+    ("all tools", all_tools_mix),
+    ("mixed (70% all tools)", sample_configs),
+    ("custom tool subsets", custom_tools_mix),
+]
+
+def run(configs, layout):
+    stand_in = PrefixCacheStandIn()
+    allowed_names = get_allowed_names().raw
+    elapsed = 0.0
+    for i, config in enumerate(configs):
+        user, min_ex, max_ex = get_user_config_from_model(config)
+        catalog_view = get_catalog_view(user.level, user.gender)
+        split_config = next(c for c in SPLIT_CONFIGS[str(user.freq)] if c['id'] == config.split_id)
+        started = time.perf_counter()
+        prompt = build_prompt(user, catalog_view.catalog, str(config.duration), min_ex, max_ex, split_config,
+                              allowed_names=allowed_names, rng=random.Random(SEED + i), layout=layout)
+        elapsed += time.perf_counter() - started
+        stand_in.submit(prompt)
+    return stand_in, elapsed
+
+def main():
+    print(f"Requests per mix: {NUM_REQUESTS}, block size: {BLOCK_SIZE} tokens (regex-approximated)\n")
+    for mix_label, make_mix in REQUEST_MIXES:
+        configs = make_mix(NUM_REQUESTS, random.Random(SEED))
+        print(f"[{mix_label}]")
+        for layout in ["default", "prefix_cache"]:
+            stand_in, elapsed = run(configs, layout)
+            print(f"  {layout}:")
+            print(f"    shared-prefix ratio: {stand_in.cached_tokens / stand_in.prompt_tokens:.2%} of prompt tokens served from cache")
+            print(f"    mean prompt tokens: {stand_in.prompt_tokens / len(configs):.0f}, mean reused: {stand_in.cached_tokens / len(configs):.0f}")
+            print(f"    cached blocks: {len(stand_in.blocks)}, prompt build time: {elapsed * 1000 / len(configs):.3f} ms/request")
+        print()
+
+if __name__ == "__main__":
+    main()
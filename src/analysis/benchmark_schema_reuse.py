@@ -0,0 +1,113 @@
+import hashlib
+import os
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# --- Configuration ---
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+NUM_REQUESTS = 2000
+SEED = 42
+
+sys.path.insert(0, str(BASE_DIR))
+
+from web.main import (  # noqa: E402
+    EXERCISE_COUNT_SCHEMA, SPLIT_CONFIGS, PREWARM_TOOL_SETS,
+    build_week_schema_by_name, serialize_schema, get_allowed_names, get_catalog_view,
+    get_user_config_from_model, _prepare_allowed_names, UserConfig,
+)
+
+ALL_TOOLS = PREWARM_TOOL_SETS[0]
+
+class GrammarCacheStandIn:
+    """Local stand-in for vLLM's compiled-grammar cache: one compile per distinct guided_json string."""
+
+    def __init__(self):
+        self.compiled = set()
+        self.hits = 0
+        self.misses = 0
+
+    def submit(self, guided_json: str):
+        key = hashlib.sha256(guided_json.encode('utf-8')).hexdigest()
+        if key in self.compiled:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.compiled.add(key)
+
+def sample_configs(n, rng):
+    """Draws a request mix: mostly the default all-tools selection, with some narrower tool subsets."""
+    configs = []
+    for _ in range(n):
+        freq = rng.choice(list(SPLIT_CONFIGS.keys()))
+        if rng.random() < 0.7:
+            tools = list(ALL_TOOLS)
+        else:
+            tools = rng.sample(ALL_TOOLS, rng.randint(3, len(ALL_TOOLS)))
+        configs.append(UserConfig(
+            gender=rng.choice(['M', 'F']),
+            weight=rng.randint(50, 100),
+            level=rng.choice(list(EXERCISE_COUNT_SCHEMA.keys())),
+            freq=int(freq),
+            duration=rng.choice([30, 45, 60, 75, 90]),
+            intensity=rng.choice(['Low', 'Normal', 'High']),
+            split_id=rng.choice([c['id'] for c in SPLIT_CONFIGS[freq]]),
+            tools=tools,
+        ))
+    return configs
+
+def schema_key(config):
+    user, min_ex, _ = get_user_config_from_model(config)
+    return (user.gender, user.level, user.freq, config.split_id, min_ex, frozenset(t.lower() for t in user.tools))
+
+def run(configs, canonical):
+    random.seed(SEED)
+    stand_in = GrammarCacheStandIn()
+    hashes = []
+    allowed_index = get_allowed_names()
+    started = time.perf_counter()
+    for config in configs:
+        user, min_ex, max_ex = get_user_config_from_model(config)
+        catalog_view = get_catalog_view(user.level, user.gender)
+        split_config = next(c for c in SPLIT_CONFIGS[str(user.freq)] if c['id'] == config.split_id)
+        allowed_names = _prepare_allowed_names(user, allowed_index, catalog_view.exercise_map)
+        schema = build_week_schema_by_name(user.freq, split_config['days'], allowed_names, min_ex, max_ex, catalog_view.exercise_map, level=user.level, canonical=canonical)
+        guided_json = serialize_schema(schema, canonical=canonical)
+        stand_in.submit(guided_json)
+        hashes.append(hashlib.sha256(guided_json.encode('utf-8')).hexdigest())
+    return stand_in, hashes, time.perf_counter() - started
+
+def hashes_in_other_process(canonical, hash_seed):
+    """Rebuilds the same request mix in a fresh interpreter, as another uvicorn worker or a restart would."""
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    output = subprocess.run(
+        [sys.executable, __file__, "--hashes", "canonical" if canonical else "legacy"],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return output.split()
+
+def main():
+    rng = random.Random(SEED)
+    configs = sample_configs(NUM_REQUESTS, rng)
+    distinct = len({schema_key(c) for c in configs})
+    print(f"Requests: {len(configs)}, distinct (gender, level, freq, split, min_ex, tools) configurations: {distinct}")
+    print(f"Hit rate if every configuration compiled exactly once: {1 - distinct / len(configs):.2%}\n")
+
+    for label, canonical in [("legacy (shuffled)", False), ("canonical", True)]:
+        stand_in, hashes, elapsed = run(configs, canonical)
+        total = stand_in.hits + stand_in.misses
+        other_hashes = hashes_in_other_process(canonical, hash_seed=1)
+        same = sum(1 for a, b in zip(hashes, other_hashes) if a == b)
+        print(f"[{label}]")
+        print(f"  grammar compiles: {stand_in.misses}, reuses: {stand_in.hits}, hit rate: {stand_in.hits / total:.2%}")
+        print(f"  identical schema in a second process: {same / total:.2%}")
+        print(f"  schema build time: {elapsed * 1000 / total:.3f} ms/request")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--hashes":
+        _, hashes, _ = run(sample_configs(NUM_REQUESTS, random.Random(SEED)), sys.argv[2] == "canonical")
+        print("\n".join(hashes))
+    else:
+        main()
@@ -0,0 +1,125 @@
+import random
+import sys
+from pathlib import Path
+
+# --- Configuration ---
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+SAMPLES_PER_SCHEMA = 20
+SEED = 42
+
+sys.path.insert(0, str(BASE_DIR))
+
+from web.main import (  # noqa: E402
+    CATALOG_CODES, CANONICAL_SCHEMAS, EXERCISE_COUNT_SCHEMA, SPLIT_CONFIGS, PREWARM_TOOL_SETS,
+    UserConfig, build_week_schema_by_name, dedupe_schema_enums, encode_schema_exercise_ids,
+    get_allowed_names, get_catalog_view, get_user_config_from_model, serialize_schema, _prepare_allowed_names,
+)
+
+try:
+    from jsonschema import Draft202012Validator
+except ImportError:
+    sys.exit("check_schema_refs.py needs jsonschema: pip install -r requirements-dev.txt")
+
+# (catalog encoding, output format) pairs, as in benchmark_catalog_encoding.py
+OUTPUT_MODES = [("json", "pairs"), ("compact", "pairs"), ("compact", "ids")]
+
+def _resolve(ref, root):
+    node = root
+    for part in ref.lstrip('#').strip('/').split('/'):
+        node = node[part]
+    return node
+
+def is_valid(instance, schema) -> bool:
+    return Draft202012Validator(schema).is_valid(instance)
+
+def sample_instance(node, root, rng):
+    """Draws a random instance the schema accepts."""
+    if "$ref" in node:
+        return sample_instance(_resolve(node["$ref"], root), root, rng)
+    if "enum" in node:
+        return rng.choice(node["enum"])
+    if node.get("type") == "array":
+        prefix_items = node.get("prefixItems", [])
+        length = rng.randint(node.get("minItems", 0), node.get("maxItems", node.get("minItems", 0)))
+        return [sample_instance(prefix_items[i] if i < len(prefix_items) else node["items"], root, rng) for i in range(length)]
+    return {key: sample_instance(sub_schema, root, rng) for key, sub_schema in node.get("properties", {}).items()}
+
+def all_enum_values(node, values):
+    if isinstance(node, dict):
+        if isinstance(node.get("enum"), list):
+            values.extend(node["enum"])
+        for value in node.values():
+            all_enum_values(value, values)
+    elif isinstance(node, list):
+        for item in node:
+            all_enum_values(item, values)
+    return values
+
+def mutations(instance, pool, rng):
+    """Near-miss outputs: each breaks (or may break) one constraint of a valid instance."""
+    days = instance["days"]
+    day = rng.randrange(len(days))
+    slot = rng.randrange(len(days[day])) if days[day] else 0
+
+    def mutated(change):
+        copy = {"days": [list(d) for d in days]}
+        change(copy["days"])
+        return copy
+
+    yield mutated(lambda d: d[day].__setitem__(slot, rng.choice(pool)) if d[day] else None)
+    yield mutated(lambda d: d[day].append(rng.choice(pool)))
+    yield mutated(lambda d: d[day].pop() if d[day] else None)
+    yield mutated(lambda d: d[day].reverse())
+    yield mutated(lambda d: d.pop())
+    yield mutated(lambda d: d[day].__setitem__(slot, 0 if isinstance(d[day][slot], int) else ["Chest", "Unknown Exercise"]) if d[day] else None)
+
+def schemas_for(config, catalog_encoding, output_format):
+    user, min_ex, max_ex = get_user_config_from_model(config)
+    catalog_view = get_catalog_view(user.level, user.gender)
+    split_config = next(c for c in SPLIT_CONFIGS[str(user.freq)] if c['id'] == config.split_id)
+    allowed_names = _prepare_allowed_names(user, get_allowed_names(), catalog_view.exercise_map)
+    inline = build_week_schema_by_name(user.freq, split_config['days'], allowed_names, min_ex, max_ex, catalog_view.exercise_map, level=user.level, canonical=CANONICAL_SCHEMAS)
+    if catalog_encoding == "compact":
+        inline = encode_schema_exercise_ids(inline, CATALOG_CODES.exercise_ids, canonical=CANONICAL_SCHEMAS, bare=(output_format == "ids"))
+    return inline, dedupe_schema_enums(inline)
+
+def main():
+    rng = random.Random(SEED)
+    mismatches = 0
+    for catalog_encoding, output_format in OUTPUT_MODES:
+        checked = accepted = 0
+        inline_bytes = ref_bytes = inline_enums = ref_enums = 0
+        for freq, split_options in SPLIT_CONFIGS.items():
+            for split_config in split_options:
+                for level in EXERCISE_COUNT_SCHEMA:
+                    for gender in ['M', 'F']:
+                        for tools in PREWARM_TOOL_SETS:
+                            config = UserConfig(gender=gender, weight=70, level=level, freq=int(freq), duration=60,
+                                                intensity='Normal', split_id=split_config['id'], tools=list(tools))
+                            inline, deduped = schemas_for(config, catalog_encoding, output_format)
+                            inline_bytes += len(serialize_schema(inline, canonical=CANONICAL_SCHEMAS).encode('utf-8'))
+                            ref_bytes += len(serialize_schema(deduped, canonical=CANONICAL_SCHEMAS).encode('utf-8'))
+                            inline_enums += len(all_enum_values(inline, []))
+                            ref_enums += len(all_enum_values(deduped, []))
+
+                            pool = all_enum_values(inline, [])
+                            for _ in range(SAMPLES_PER_SCHEMA):
+                                valid = sample_instance(inline, inline, rng)
+                                for instance in [valid, *mutations(valid, pool, rng)]:
+                                    verdict = is_valid(instance, inline)
+                                    checked += 1
+                                    accepted += verdict
+                                    if verdict != is_valid(instance, deduped):
+                                        mismatches += 1
+                                        print(f"  MISMATCH {catalog_encoding}/{output_format} {freq}/{split_config['id']} {level} {gender}: {instance}")
+
+        print(f"[{catalog_encoding}/{output_format}]")
+        print(f"  outputs validated: {checked} ({accepted} accepted, {checked - accepted} rejected)")
+        print(f"  guided_json size: {inline_bytes / 1024:.0f} KB inline -> {ref_bytes / 1024:.0f} KB with $defs ({1 - ref_bytes / inline_bytes:.1%} smaller)")
+        print(f"  enum entries to compile: {inline_enums} -> {ref_enums} ({1 - ref_enums / inline_enums:.1%} fewer)")
+
+    print(f"\nValidation mismatches between inline and $defs schemas: {mismatches}")
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
 
 import json
 import urllib.request
-import time
 import os
 
 # --- Configuration ---
 TEST_CASES_PATH = os.path.join('web', 'test_cases.json')
-API_ENDPOINT = 'http://127.0.0.1:5001/api/infer'
+API_ENDPOINT = 'http://127.0.0.1:5001/api/infer/batch'
 TOTAL_CASES = 80 # Expected number of cases
+BATCH_CONCURRENCY = 16 # Concurrent vLLM requests the server runs for a batch
+BATCH_TIMEOUT = 1800
 
 # --- Sorting Logic (replicated from script.js) ---
 def get_sort_key(exercise):
@@ -57,13 +58,14 @@ def run_tests():
     for week_num in range(1, 5):
         print(f"\n--- Generating routines for Week {week_num} ---\n")
         
+        pending = []
         for i, case in enumerate(cases_to_process):
             # Check if the routine for the current week already exists and is valid
             if f'week{week_num}' in case and case.get(f'week{week_num}') and 'error' not in case.get(f'week{week_num}', {}):
                 print(f"  Skipping case {i+1}/{len(cases_to_process)}: Week {week_num} data already exists.")
                 continue
 
-            print(f"--- Processing case {i+1}/{len(cases_to_process)} for Week {week_num}: {case['gender']}-{case['level']}-{case['freq']}day-{case['split_id']} ---")
+            print(f"--- Queueing case {i+1}/{len(cases_to_process)} for Week {week_num}: {case['gender']}-{case['level']}-{case['freq']}day-{case['split_id']} ---")
 
             # Server now handles all level-based tool filtering. Client sends all available tools.
             tools_list = ["Barbell", "Dumbbell", "Machine", "Bodyweight", "EZbar", "Etc", "PullUpBar"]
@@ -84,41 +86,54 @@ def run_tests():
                 "max_tokens": 4096,
                 "temperature": 1.0
             }
-            
-            try:
-                # Prepare and send the request
-                data = json.dumps(payload).encode('utf-8')
-                headers = {'Content-Type': 'application/json'}
-                req = urllib.request.Request(API_ENDPOINT, data=data, headers=headers, method='POST')
-                
-                with urllib.request.urlopen(req, timeout=180) as response:
-                    if response.status != 200:
-                        print(f"  Error: Received status {response.status}. Skipping.")
-                        raw_body = response.read().decode('utf-8', errors='ignore')
-                        print(f"  Response body: {raw_body}")
+            pending.append((case, payload))
+
+        if not pending:
+            continue
+
+        print(f"  Sending {len(pending)} cases for Week {week_num} as one batch...")
+        try:
+            # Prepare and send the batch request
+            data = json.dumps({"configs": [payload for _, payload in pending], "concurrency": BATCH_CONCURRENCY}).encode('utf-8')
+            headers = {'Content-Type': 'application/json'}
+            req = urllib.request.Request(API_ENDPOINT, data=data, headers=headers, method='POST')
+
+            with urllib.request.urlopen(req, timeout=BATCH_TIMEOUT) as response:
+                if response.status != 200:
+                    print(f"  Error: Received status {response.status}.")
+                    raw_body = response.read().decode('utf-8', errors='ignore')
+                    print(f"  Response body: {raw_body}")
+                    for case, _ in pending:
                         case[f'week{week_num}'] = {"error": f"HTTP {response.status}"}
-                    else:
-                        response_data = json.loads(response.read().decode('utf-8'))
-                        
-                        # Process the received routine
-                        raw_routine = response_data.get('routine', {})
-                        simplified_routine = {}
-                        
-                        if raw_routine and 'days' in raw_routine:
-                            for day_exercises in raw_routine['days']:
-                                day_exercises.sort(key=get_sort_key)
-                            for day_idx, day_exercises in enumerate(raw_routine['days']):
-                                day_key = f"Day {day_idx + 1}"
-                                simplified_routine[day_key] = [ex.get('kName', 'Unknown') for ex in day_exercises]
-                        
-                        case[f'week{week_num}'] = simplified_routine
-                        print(f"  Success: Routine for Week {week_num} generated and processed.")
-
-            except Exception as e:
-                print(f"  An error occurred during API call or processing for Week {week_num}: {e}")
+                    results = []
+                else:
+                    results = json.loads(response.read().decode('utf-8')).get('results', [])
+        except Exception as e:
+            print(f"  An error occurred during the batch API call for Week {week_num}: {e}")
+            for case, _ in pending:
                 case[f'week{week_num}'] = {"error": str(e)}
-            
-            time.sleep(1) # Be nice to the server
+            results = []
+
+        for result in results:
+            case, _ = pending[result['index']]
+            if 'error' in result:
+                print(f"  Error for case {result['index']+1}: HTTP {result.get('status_code')} - {result['error']}")
+                case[f'week{week_num}'] = {"error": f"HTTP {result.get('status_code')}"}
+                continue
+
+            # Process the received routine
+            raw_routine = result.get('routine', {})
+            simplified_routine = {}
+
+            if raw_routine and 'days' in raw_routine:
+                for day_exercises in raw_routine['days']:
+                    day_exercises.sort(key=get_sort_key)
+                for day_idx, day_exercises in enumerate(raw_routine['days']):
+                    day_key = f"Day {day_idx + 1}"
+                    simplified_routine[day_key] = [ex.get('kName', 'Unknown') for ex in day_exercises]
+
+            case[f'week{week_num}'] = simplified_routine
+        print(f"  Week {week_num}: {sum(1 for r in results if 'error' not in r)}/{len(pending)} routines generated and processed.")
 
         # Save results after each week's batch processing
         print(f"\n--- All cases for Week {week_num} processed. Writing results to {TEST_CASES_PATH}... ---")
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict
+
+
+@dataclass(frozen=True)
+class Lane:
+    name: str
+    max_queue: int  # Waiting requests allowed before new ones are shed
+    max_wait: float  # Seconds a request may wait for a slot before it is shed
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, lane: str, reason: str, retry_after: int):
+        super().__init__(f"{lane} lane {reason}")
+        self.lane = lane
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounds concurrent work and queues the excess in priority lanes.
+
+    Lanes are listed highest priority first: a freed slot always goes to the oldest waiter of
+    the highest-priority non-empty lane. Requests beyond a lane's queue depth, or still waiting
+    after its max_wait, are rejected with an estimated Retry-After.
+    """
+
+    def __init__(self, max_concurrency: int, lanes):
+        self.max_concurrency = max_concurrency
+        self.lanes: Dict[str, Lane] = {lane.name: lane for lane in lanes}
+        self._waiters: Dict[str, deque] = {name: deque() for name in self.lanes}
+        self.in_use = 0
+        self.admitted = {name: 0 for name in self.lanes}
+        self.rejected = {name: {"queue_full": 0, "wait_timeout": 0} for name in self.lanes}
+        # Exponentially weighted average of how long admitted work holds a slot
+        self.avg_service_time = 1.0
+
+    def _queued_ahead(self, lane: str) -> int:
+        # Waiters in this lane and every higher-priority lane are served first
+        ahead = 0
+        for name in self.lanes:
+            ahead += len(self._waiters[name])
+            if name == lane:
+                break
+        return ahead
+
+    def retry_after(self, lane: str) -> int:
+        waves = (self._queued_ahead(lane) + 1) / max(self.max_concurrency, 1)
+        return max(1, math.ceil(waves * self.avg_service_time))
+
+    def _reject(self, lane: str, reason: str):
+        self.rejected[lane][reason] += 1
+        raise AdmissionRejected(lane, reason, self.retry_after(lane))
+
+    async def acquire(self, lane: str) -> float:
+        """Waits for a slot; returns the seconds spent queued. Raises AdmissionRejected."""
+        config = self.lanes[lane]
+        if self.in_use < self.max_concurrency and not any(self._waiters.values()):
+            self.in_use += 1
+            self.admitted[lane] += 1
+            return 0.0
+        if len(self._waiters[lane]) >= config.max_queue:
+            self._reject(lane, "queue_full")
+
+        started = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=config.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self._waiters[lane].remove(waiter)
+                self._reject(lane, "wait_timeout")
+        except BaseException:
+            # Caller went away; give back a slot that was handed over in the meantime
+            if waiter.done() and not waiter.cancelled():
+                self.release(0.0)
+            else:
+                waiter.cancel()
+                if waiter in self._waiters[lane]:
+                    self._waiters[lane].remove(waiter)
+            raise
+        self.admitted[lane] += 1
+        return time.perf_counter() - started
+
+    def release(self, held_for: float):
+        if held_for > 0:
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * held_for
+        for name in self.lanes:
+            queue = self._waiters[name]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    # Hand the slot over directly; in_use stays the same
+                    waiter.set_result(True)
+                    return
+        self.in_use -= 1
+
+    @asynccontextmanager
+    async def admit(self, lane: str):
+        waited = await self.acquire(lane)
+        started = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_use": self.in_use,
+            "avg_service_time": round(self.avg_service_time, 3),
+            "lanes": {
+                name: {
+                    "queued": len(self._waiters[name]),
+                    "max_queue": lane.max_queue,
+                    "max_wait": lane.max_wait,
+                    "admitted": self.admitted[name],
+                    "rejected": dict(self.rejected[name]),
+                }
+                for name, lane in self.lanes.items()
+            },
+        }
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    The shared call runs in its own task, so a caller that disconnects does not cancel the
+    work for the others that are still waiting on it.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._in_flight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+        else:
+            self.followers += 1
+        return await asyncio.shield(task)
+
+    def _on_done(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the exception as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+@dataclass(frozen=True)
+class StoredResult:
+    fingerprint: str
+    result: Any
+    expires_at: float
+
+
+class IdempotencyStore:
+    """In-memory TTL store of successful results, keyed by the client's Idempotency-Key."""
+
+    def __init__(self, ttl: float = 600.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.replays = 0
+        self._entries: "OrderedDict[str, StoredResult]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[StoredResult]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def put(self, key: str, fingerprint: str, result: Any):
+        self._entries[key] = StoredResult(fingerprint=fingerprint, result=result, expires_at=time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "replays": self.replays,
+        }
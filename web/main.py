@@ -1,27 +1,73 @@
 import re
 import json
+import hashlib
+import hmac
 import os
 import logging
+import asyncio
 import random
-from typing import Dict, List, Tuple, Optional
-
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable, Dict, List, Literal, Tuple, Optional, Mapping
+
+import httpx
 import openai
 from openai import OpenAI, AsyncOpenAI
 from json_repair import repair_json as json_repair_str
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, HTTPException, status, Depends, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, status, Depends, Request, Header, Query
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 
-from .util import build_prompt, SPLIT_CONFIGS, M_ratio_weight, F_ratio_weight, User as UtilUser # Alias User to avoid conflict
+from . import jsonio
+from .jsonio import FastJSONResponse
+from .precompressed import PrecompressedPayload
+from .admission import AdmissionController, AdmissionRejected, Lane
+from .coalescing import SingleFlight, IdempotencyStore
+from .profiling import profile_to_dir
+from .scoring import build_muscle_contributions, score_candidate
+from .solver import day_slots_from_schema, solve_week
+from .metrics import REGISTRY, TOKENS_TOTAL, FIXES_TOTAL, BACKEND_ERRORS_TOTAL, OUTPUT_PARSE_TOTAL, HEDGE_TOTAL, ADMISSION_REJECTED_TOTAL, SOLVER_FALLBACK_TOTAL, TOKEN_BUDGET_USAGE, TOKEN_BUDGET_TRUNCATED_TOTAL, timed_stage, record_stage, start_request_timings, server_timing_header
+from .response_cache import ResponseCache, response_cache_key
+from .token_budget import TokenCounter, schema_texts, schema_token_budget
+from .util import build_prompt, build_catalog_codes, DEFAULT_CATALOG_ENCODING, CATALOG_FRAGMENT_CACHE, SPLIT_CONFIGS, M_ratio_weight, F_ratio_weight, User as UtilUser # Alias User to avoid conflict
 
 # --- FastAPI App Initialization ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global RESPONSE_CACHE
+    # App-lifetime backend clients so connections are pooled and reused across requests
+    BACKENDS["vllm"] = BackendClient("vllm", base_url=VLLM_BASE_URL, api_key="token-1234")
+    if OPENAI_API_KEY:
+        BACKENDS["openai"] = BackendClient("openai", api_key=OPENAI_API_KEY)
+    CATALOG_VERSIONS.write_manifest()
+    RESPONSE_CACHE = _open_response_cache()
+    if SCHEMA_CACHE_PREWARM:
+        prewarm_week_schema_cache()
+        if TOKEN_BUDGET_ENABLED:
+            await prewarm_token_counts()
+    try:
+        yield
+    finally:
+        for backend in list(BACKENDS.values()):
+            await backend.aclose()
+        BACKENDS.clear()
+        await TOKEN_COUNTER.aclose()
+        if RESPONSE_CACHE is not None:
+            RESPONSE_CACHE.close()
+            RESPONSE_CACHE = None
+
 app = FastAPI(
     title="Weekly Routine AI",
     description="AI-powered weekly workout routine generator using VLLM or OpenAI.",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
 
 # Configure logging
@@ -36,6 +82,10 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_DIR = os.path.join(BASE_DIR, 'data')
 EXERCISE_CATALOG_PATH = os.path.join(DATA_DIR, '02_processed', 'processed_query_result_200.json')
 EXERCISE_SIMILARITY_PATH = os.path.join(DATA_DIR, '02_processed', 'exercise_similarity.json')
+ALLOWED_NAMES_PATH = os.path.join(os.path.dirname(__file__), "allowed_name_200.json")
+CATALOG_MANIFEST_DIR = os.getenv("CATALOG_MANIFEST_DIR", os.path.join(BASE_DIR, '.cache', 'catalog_versions'))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(BASE_DIR, '.cache', 'profiles'))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", os.path.join(BASE_DIR, '.cache', 'responses.sqlite3'))
 
 # --- Load Exercise Catalog and Name Maps ---
 exercise_catalog = []
@@ -85,6 +135,67 @@ except (FileNotFoundError, json.JSONDecodeError) as e:
     # Exit or raise an exception if catalog is critical for app function
     raise RuntimeError(f"Failed to load exercise catalog: {e}")
 
+# --- Allowed Names Index (loaded once, hot-reloaded on mtime change) ---
+
+LEVEL_KEYS = ('MBeginner', 'FBeginner', 'MNovice', 'FNovice')
+ALLOWED_NAMES_RELOAD_INTERVAL = float(os.getenv("ALLOWED_NAMES_RELOAD_INTERVAL", "5"))
+
+@dataclass(frozen=True)
+class AllowedNames:
+    raw: dict  # Parsed allowed_name_200.json; shared between requests and never mutated
+    list_sets: Dict[str, frozenset]
+    level_sets: Dict[str, frozenset]
+    tool_sets: Dict[str, frozenset]
+    mtime_ns: int
+
+    def level_set(self, level: str, gender: str) -> Optional[frozenset]:
+        """Returns the Beginner/Novice exercise set for the user, or None for other levels."""
+        if level not in ('Beginner', 'Novice'):
+            return None
+        return self.level_sets.get(f"{'M' if gender == 'M' else 'F'}{level}", frozenset())
+
+def _load_allowed_names(path: str) -> AllowedNames:
+    mtime_ns = os.stat(path).st_mtime_ns
+    with open(path, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+
+    list_sets = {key: frozenset(value) for key, value in raw.items() if isinstance(value, list)}
+
+    return AllowedNames(
+        raw=raw,
+        list_sets=list_sets,
+        level_sets={key: list_sets.get(key, frozenset()) for key in LEVEL_KEYS},
+        tool_sets={tool: frozenset(names) for tool, names in raw.get('TOOL', {}).items()},
+        mtime_ns=mtime_ns,
+    )
+
+try:
+    _allowed_names = _load_allowed_names(ALLOWED_NAMES_PATH)
+except (OSError, json.JSONDecodeError) as e:
+    app.logger.error(f"CRITICAL: Could not load allowed names at {ALLOWED_NAMES_PATH}: {e}")
+    raise RuntimeError(f"Failed to load allowed names: {e}")
+_allowed_names_checked_at = time.monotonic()
+
+def get_allowed_names() -> AllowedNames:
+    """Returns the current allowed-names index, reloading it when the file's mtime changes.
+
+    The mtime is checked at most once per ALLOWED_NAMES_RELOAD_INTERVAL seconds; the new index
+    is fully built before it replaces the old one, and a failed reload keeps the old index.
+    """
+    global _allowed_names, _allowed_names_checked_at
+    now = time.monotonic()
+    if now - _allowed_names_checked_at < ALLOWED_NAMES_RELOAD_INTERVAL:
+        return _allowed_names
+    _allowed_names_checked_at = now
+
+    try:
+        if os.stat(ALLOWED_NAMES_PATH).st_mtime_ns != _allowed_names.mtime_ns:
+            _allowed_names = _load_allowed_names(ALLOWED_NAMES_PATH)
+            app.logger.info(f"Reloaded allowed names from {ALLOWED_NAMES_PATH}")
+    except (OSError, json.JSONDecodeError) as e:
+        app.logger.error(f"Could not reload allowed names at {ALLOWED_NAMES_PATH}, keeping previous version: {e}")
+    return _allowed_names
+
 # --- Global Variables & Helper Functions ---
 
 VLLM_BASE_URL = os.getenv("VLLM_BASE_URL", "http://127.0.0.1:8000/v1")
@@ -92,6 +203,109 @@ VLLM_MODEL    = "google/gemma-3-4b-it"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 
+# --- Backend Clients ---
+
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "100"))
+BACKEND_MAX_KEEPALIVE = int(os.getenv("BACKEND_MAX_KEEPALIVE", "20"))
+BACKEND_KEEPALIVE_EXPIRY = float(os.getenv("BACKEND_KEEPALIVE_EXPIRY", "30"))
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", "600"))
+BACKEND_HTTP2 = os.getenv("BACKEND_HTTP2", "1") == "1"
+BACKEND_LATENCY_WINDOW = int(os.getenv("BACKEND_LATENCY_WINDOW", "500"))
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+except ImportError:
+    if BACKEND_HTTP2:
+        app.logger.warning("BACKEND_HTTP2 is enabled but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+    BACKEND_HTTP2 = False
+
+class BackendClient:
+    """An AsyncOpenAI client with its own connection pool, shared by all requests to one backend."""
+
+    def __init__(self, name: str, **client_kwargs):
+        self.name = name
+        self.limits = httpx.Limits(
+            max_connections=BACKEND_MAX_CONNECTIONS,
+            max_keepalive_connections=BACKEND_MAX_KEEPALIVE,
+            keepalive_expiry=BACKEND_KEEPALIVE_EXPIRY,
+        )
+        self.http_client = openai.DefaultAsyncHttpxClient(limits=self.limits, http2=BACKEND_HTTP2, timeout=BACKEND_TIMEOUT)
+        self.client = AsyncOpenAI(http_client=self.http_client, timeout=BACKEND_TIMEOUT, **client_kwargs)
+        self.in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        # Latencies of recent successful non-streaming calls, for hedging decisions
+        self.latencies = deque(maxlen=BACKEND_LATENCY_WINDOW)
+
+    async def create_chat_completion(self, **kwargs):
+        self.in_flight += 1
+        self.requests_total += 1
+        started = time.perf_counter()
+        try:
+            resp = await self.client.chat.completions.create(**kwargs)
+        except Exception as e:
+            self.errors_total += 1
+            BACKEND_ERRORS_TOTAL.inc(backend=self.name, error=type(e).__name__)
+            raise
+        finally:
+            self.in_flight -= 1
+        if not kwargs.get("stream"):
+            self.latencies.append(time.perf_counter() - started)
+        usage = getattr(resp, "usage", None)
+        if usage is not None:
+            TOKENS_TOTAL.inc(usage.prompt_tokens or 0, backend=self.name, kind="prompt")
+            TOKENS_TOTAL.inc(usage.completion_tokens or 0, backend=self.name, kind="completion")
+        return resp
+
+    def latency_percentile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        if len(self.latencies) < max(min_samples, 1):
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def pool_connections(self) -> Tuple[Optional[int], Optional[int]]:
+        """(open, idle) connection counts, or (None, None) when the pool cannot be inspected.
+
+        httpx has no public pool API, so this reads httpcore's private pool and reports the counts as
+        unknown rather than zero if a future httpx/httpcore moves it.
+        """
+        pool = getattr(getattr(self.http_client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is None:
+            return None, None
+        try:
+            connections = list(connections)
+            return len(connections), sum(1 for c in connections if c.is_idle())
+        except Exception:
+            return None, None
+
+    def stats(self) -> dict:
+        connections_open, connections_idle = self.pool_connections()
+        return {
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "connections_open": connections_open,
+            "connections_idle": connections_idle,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "http2": BACKEND_HTTP2,
+            "latency_p50": self.latency_percentile(0.5),
+            "latency_p95": self.latency_percentile(0.95),
+        }
+
+    async def aclose(self):
+        await self.client.close()
+
+BACKENDS: Dict[str, BackendClient] = {}
+
+def get_backend(name: str) -> BackendClient:
+    backend = BACKENDS.get(name)
+    if backend is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Backend '{name}' is not available.")
+    return backend
+
 EXERCISE_COUNT_SCHEMA = {
     'Beginner': {
         30: (3, 4), 45: (4, 5), 60: (5, 6), 75: (6, 7), 90: (7, 8)
@@ -107,7 +321,102 @@ EXERCISE_COUNT_SCHEMA = {
     }
 }
 
+# --- Precomputed Catalog Views ---
+# Per-(level, gender) read-only views of the catalog, built once at startup so that
+# requests never copy the catalog. Level-specific main_ex overlays are applied here.
+
+BEGINNER_MAIN_LEGS = frozenset({"Leg Press", "Dumbbell Lunge", "Smith Machine Squat", "Dumbbell Goblet Squat", "Air Squat"})
+
+@dataclass(frozen=True)
+class CandidateIndex:
+    """Exercise names grouped for post-validation lookups. Every list keeps exercise_map order."""
+    main_by_bp: Dict[str, List[str]]
+    main_sets: Dict[str, frozenset]
+    by_bp_and_main: Dict[tuple, List[str]]
+
+def build_candidate_index(exercise_map) -> CandidateIndex:
+    main_by_bp = {}
+    by_bp_and_main = {}
+    for name, ex in exercise_map.items():
+        by_bp_and_main.setdefault((ex.get('bName'), ex.get('main_ex', False)), []).append(name)
+        if ex.get('main_ex'):
+            main_by_bp.setdefault(ex.get('bName'), []).append(name)
+    return CandidateIndex(
+        main_by_bp=main_by_bp,
+        main_sets={bp: frozenset(names) for bp, names in main_by_bp.items()},
+        by_bp_and_main=by_bp_and_main,
+    )
+
+@dataclass(frozen=True)
+class CatalogView:
+    catalog: Tuple[Mapping, ...]
+    exercise_map: Mapping[str, Mapping]
+    enrichment: Mapping[str, Mapping]
+    candidate_index: CandidateIndex
+
+def _build_catalog_view(level: str, gender: str) -> CatalogView:
+    """Builds an immutable catalog view with the level's main_ex overlay and the /api/infer enrichment fields resolved."""
+    view_catalog = []
+    for exercise in exercise_catalog:
+        view_exercise = dict(exercise)
+        if level == 'Beginner' and view_exercise.get('bName') == 'Leg':
+            view_exercise['main_ex'] = view_exercise.get('eName') in BEGINNER_MAIN_LEGS
+        view_catalog.append(MappingProxyType(view_exercise))
+
+    exercise_map = {}
+    enrichment = {}
+    for exercise in view_catalog:
+        e_name = exercise.get('eName')
+        exercise_map[e_name] = exercise
+        enrichment[e_name] = MappingProxyType({
+            "kName": exercise.get("kName", e_name),
+            "MG_num": exercise.get("MG_num", 0),
+            "musle_point_sum": exercise.get("musle_point_sum", 0),
+            "main_ex": exercise.get("main_ex", False),
+            "eInfoType": name_to_einfotype_map.get(e_name),
+            "tool_en": exercise.get("tool_en", "Etc"),
+        })
+
+    return CatalogView(
+        catalog=tuple(view_catalog),
+        exercise_map=MappingProxyType(exercise_map),
+        enrichment=MappingProxyType(enrichment),
+        candidate_index=build_candidate_index(exercise_map),
+    )
+
+CATALOG_VIEWS = {
+    (level, gender): _build_catalog_view(level, gender)
+    for level in EXERCISE_COUNT_SCHEMA
+    for gender in ('M', 'F')
+}
+
+# Integer exercise IDs and tool/muscle codes for the compact catalog encoding
+CATALOG_CODES = build_catalog_codes(exercise_catalog)
+EXERCISE_NAMES_BY_ID = CATALOG_CODES.names_by_id
+
+# "pairs" keeps [bodypart, exercise] items; "ids" has the model emit only exercise IDs,
+# several times fewer generated tokens. IDs only exist in the compact catalog encoding.
+GUIDED_OUTPUT_FORMAT = os.getenv("GUIDED_OUTPUT_FORMAT", "pairs")
+
+def resolve_output_encoding(catalog_encoding: Optional[str] = None, output_format: Optional[str] = None) -> Tuple[str, str]:
+    """Returns (catalog_encoding, output_format) for a request; 'ids' output implies the compact catalog."""
+    output_format = output_format or GUIDED_OUTPUT_FORMAT
+    if output_format == "ids":
+        if catalog_encoding == "json":
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="output_format 'ids' requires catalog_encoding 'compact'")
+        return "compact", output_format
+    return catalog_encoding or DEFAULT_CATALOG_ENCODING, output_format
+
+def get_catalog_view(level: str, gender: str) -> CatalogView:
+    """Returns the shared catalog view for a user. Unknown values fall back to a view without level overlays."""
+    view = CATALOG_VIEWS.get((level, gender))
+    if view is None:
+        view = CATALOG_VIEWS[(level if level in EXERCISE_COUNT_SCHEMA else 'Intermediate', 'M')]
+    return view
+
 # --- Pydantic Models for Request Bodies ---
+BEST_OF_MAX_CANDIDATES = int(os.getenv("BEST_OF_MAX_CANDIDATES", "8"))
+
 class UserConfig(BaseModel):
     gender: str = Field(..., description="User's gender (M/F)")
     weight: float = Field(..., gt=0, description="User's weight in kg")
@@ -119,12 +428,40 @@ class UserConfig(BaseModel):
     tools: List[str] = Field([], description="List of allowed exercise tools (e.g., Barbell, Dumbbell)")
     prevent_weekly_duplicates: bool = Field(True, description="Prevent duplicate exercises across the week")
     prevent_category_duplicates: bool = Field(True, description="Prevent duplicate categories within a day")
-    max_tokens: int = Field(4096, gt=0, description="Maximum tokens for AI model response")
+    max_tokens: int = Field(4096, gt=0, description="Maximum tokens for AI model response; capped by the week schema's output bound")
     temperature: float = Field(1.0, ge=0.0, le=2.0, description="Temperature for AI model generation")
     prompt: Optional[str] = Field(None, description="Optional pre-generated prompt string")
+    seed: Optional[int] = Field(None, description="Seed for the catalog shuffle, post-validation and model sampling; makes the generation reproducible")
+    n: int = Field(1, ge=1, le=BEST_OF_MAX_CANDIDATES, description="Number of candidates to sample in one backend call; the best-scoring one is returned")
+    prompt_layout: Optional[Literal["default", "prefix_cache"]] = Field(None, description="Prompt layout; defaults to PROMPT_LAYOUT. 'prefix_cache' puts user fields last for vLLM prefix caching")
+    catalog_encoding: Optional[Literal["json", "compact"]] = Field(None, description="Catalog encoding; defaults to PROMPT_CATALOG_ENCODING. 'compact' lists exercises by integer ID and the model answers with [bodypart, ID]")
+    output_format: Optional[Literal["pairs", "ids"]] = Field(None, description="Guided output shape; defaults to GUIDED_OUTPUT_FORMAT. 'ids' emits bare exercise IDs and implies the compact catalog encoding")
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+
+class BatchInferRequest(BaseModel):
+    configs: List[UserConfig] = Field(..., min_length=1, description="User configurations; results are returned in the same order")
+    concurrency: Optional[int] = Field(None, gt=0, description="Maximum concurrent backend calls for this batch (capped by BATCH_MAX_CONCURRENCY)")
+
+SIMILAR_BULK_MAX_NAMES = int(os.getenv("SIMILAR_BULK_MAX_NAMES", "200"))
+
+class SimilarExercisesRequest(BaseModel):
+    names: List[str] = Field(..., max_length=SIMILAR_BULK_MAX_NAMES, description="Exercise names (eName) to resolve")
 
 # --- Helper Functions (adapted from server.py) ---
 
+def request_rng(config: UserConfig) -> random.Random:
+    """Per-request RNG for prompt shuffling and post-validation, seeded from config.seed when given.
+
+    Unseeded temperature-0 requests are seeded from a hash of the config, so identical requests build
+    the same prompt (and response cache key) and post-validate the same way.
+    """
+    if config.seed is None and config.temperature == 0:
+        digest = hashlib.sha256(json.dumps(config.model_dump(), sort_keys=True, ensure_ascii=False).encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+    return random.Random(config.seed)
+
 def get_user_config_from_model(config: UserConfig) -> Tuple[UtilUser, int, int]:
     """Extracts user configuration from Pydantic model, creates a UtilUser object, and determines exercise counts."""
     
@@ -145,7 +482,7 @@ def get_user_config_from_model(config: UserConfig) -> Tuple[UtilUser, int, int]:
     
     return user, min_ex, max_ex
 
-def make_arm_abs_day_schema_by_name(allowed_names, min_ex, max_ex, exercise_map):
+def make_arm_abs_day_schema_by_name(allowed_names, min_ex, max_ex, exercise_map, canonical=True):
     arm_names = allowed_names.get('ARM', [])
     abs_names = allowed_names.get('ABS', [])
 
@@ -167,18 +504,22 @@ def make_arm_abs_day_schema_by_name(allowed_names, min_ex, max_ex, exercise_map)
     abs_pairs = _create_pairs(abs_names)
 
     if not arm_pairs or not abs_pairs:
-        return make_day_schema_pairs_by_name(arm_names + abs_names, min_ex, max_ex, exercise_map)
+        return make_day_schema_pairs_by_name(arm_names + abs_names, min_ex, max_ex, exercise_map, canonical=canonical)
 
     num_arm = min_ex // 2
     num_abs = min_ex - num_arm
 
     prefix_items = []
-    for _ in range(num_arm):
-        prefix_items.append({"enum": arm_pairs})
-    for _ in range(num_abs):
-        prefix_items.append({"enum": abs_pairs})
-    
-    random.shuffle(prefix_items)
+    if canonical:
+        # Fixed ARM/ABS alternation so identical configurations produce identical schemas
+        for i in range(min_ex):
+            prefix_items.append({"enum": arm_pairs} if i % 2 == 0 and i // 2 < num_arm else {"enum": abs_pairs})
+    else:
+        for _ in range(num_arm):
+            prefix_items.append({"enum": arm_pairs})
+        for _ in range(num_abs):
+            prefix_items.append({"enum": abs_pairs})
+        random.shuffle(prefix_items)
 
     return {
         "type": "array",
@@ -189,10 +530,12 @@ def make_arm_abs_day_schema_by_name(allowed_names, min_ex, max_ex, exercise_map)
         "items": False
     }
 
-def make_day_schema_pairs_by_name(allowed_names_for_day, min_ex, max_ex, exercise_map):
+def make_day_schema_pairs_by_name(allowed_names_for_day, min_ex, max_ex, exercise_map, canonical=True):
     pair_enum = []
     seen = set()
-    random.shuffle(allowed_names_for_day)
+    if not canonical:
+        allowed_names_for_day = list(allowed_names_for_day)
+        random.shuffle(allowed_names_for_day)
 
     for ex_name in allowed_names_for_day:
         exercise = exercise_map.get(ex_name)
@@ -221,7 +564,98 @@ def make_day_schema_pairs_by_name(allowed_names_for_day, min_ex, max_ex, exercis
         "items": {"enum": pair_enum},
     }
 
-def build_week_schema_by_name(freq, split_tags, allowed_names, min_ex, max_ex, exercise_map, level='Intermediate'):
+def _canonicalize_enums(node):
+    """Sorts every enum list in a schema in place and drops duplicate entries."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "enum" and isinstance(value, list):
+                if all(isinstance(v, list) for v in value):
+                    node[key] = [list(pair) for pair in sorted({tuple(pair) for pair in value})]
+                else:
+                    node[key] = sorted(set(value))
+            else:
+                _canonicalize_enums(value)
+    elif isinstance(node, list):
+        for item in node:
+            _canonicalize_enums(item)
+    return node
+
+def encode_schema_exercise_ids(node, exercise_ids: Mapping[str, int], canonical: bool = True, bare: bool = False):
+    """Returns a copy of a name-based schema whose [bodypart, eName] enum pairs use integer exercise IDs.
+
+    With bare=True each pair becomes just the ID; the server resolves bName from the catalog.
+    """
+    def _encode_enum(pairs):
+        if bare:
+            return [exercise_ids[pair[1]] for pair in pairs if pair[1] in exercise_ids]
+        return [[pair[0], exercise_ids[pair[1]]] for pair in pairs if pair[1] in exercise_ids]
+
+    def _encode(value):
+        if isinstance(value, dict):
+            return {key: _encode_enum(item) if key == "enum" else _encode(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [_encode(item) for item in value]
+        return value
+
+    encoded = _encode(node)
+    return _canonicalize_enums(encoded) if canonical else encoded
+
+def dedupe_schema_enums(schema: dict, min_uses: int = 2) -> dict:
+    """Returns a copy of a schema where every enum used at least min_uses times is defined once
+    under $defs and referenced with $ref. Definitions are named in first-use order, so equal
+    schemas still serialize identically."""
+    uses = {}
+
+    def _enum_key(node):
+        # Only bare {"enum": [...]} nodes are replaced, so no sibling keyword is lost
+        if isinstance(node, dict) and len(node) == 1 and isinstance(node.get("enum"), list):
+            return json.dumps(node["enum"], ensure_ascii=False, separators=(',', ':'))
+        return None
+
+    def _count(node):
+        key = _enum_key(node)
+        if key is not None:
+            uses[key] = uses.get(key, 0) + 1
+        elif isinstance(node, dict):
+            for value in node.values():
+                _count(value)
+        elif isinstance(node, list):
+            for item in node:
+                _count(item)
+
+    _count(schema)
+    defs = {}
+    names = {}
+
+    def _replace(node):
+        key = _enum_key(node)
+        if key is not None and uses[key] >= min_uses:
+            if key not in names:
+                names[key] = f"enum{len(names)}"
+                defs[names[key]] = node
+            return {"$ref": f"#/$defs/{names[key]}"}
+        if isinstance(node, dict):
+            return {k: _replace(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [_replace(item) for item in node]
+        return node
+
+    deduped = _replace(schema)
+    if defs:
+        deduped["$defs"] = defs
+    return deduped
+
+def serialize_schema(schema: dict, canonical: bool = True) -> str:
+    """Serializes a schema compactly; canonical output also has sorted keys so equal schemas hash equally."""
+    return json.dumps(schema, ensure_ascii=False, separators=(',', ':'), sort_keys=canonical)
+
+def build_week_schema_by_name(freq, split_tags, allowed_names, min_ex, max_ex, exercise_map, level='Intermediate', canonical=True):
+    """Builds the guided_json week schema.
+
+    With canonical=True the schema is a pure function of its inputs: enums are sorted and
+    nothing is shuffled, so vLLM can reuse its compiled grammar for repeated configurations.
+    Variety comes from the shuffled catalog order in the prompt and from sampling instead.
+    """
     def _pairs_from_names(name_list):
         pairs = []
         for name in name_list:
@@ -363,13 +797,13 @@ def build_week_schema_by_name(freq, split_tags, allowed_names, min_ex, max_ex, e
                     "items": {"enum": all_pairs}
                 }
             elif tag == 'ARM+ABS':
-                day_schema = make_arm_abs_day_schema_by_name(allowed_names, min_ex, max_ex, exercise_map)
+                day_schema = make_arm_abs_day_schema_by_name(allowed_names, min_ex, max_ex, exercise_map, canonical=canonical)
             else:
-                day_schema = make_day_schema_pairs_by_name(allowed_for_day, min_ex, max_ex, exercise_map)
+                day_schema = make_day_schema_pairs_by_name(allowed_for_day, min_ex, max_ex, exercise_map, canonical=canonical)
 
         prefix.append(day_schema)
 
-    return {
+    week_schema = {
         "type": "object",
         "required": ["days"],
         "properties": {
@@ -382,11 +816,20 @@ def build_week_schema_by_name(freq, split_tags, allowed_names, min_ex, max_ex, e
             }
         }
     }
+    return _canonicalize_enums(week_schema) if canonical else week_schema
+
+def _copy_allowed_names(allowed_names: dict) -> dict:
+    """Copies the dict levels of allowed_names so they can be reassigned; the name lists are shared."""
+    return {key: dict(value) if isinstance(value, dict) else value for key, value in allowed_names.items()}
 
-def _prepare_allowed_names(user: UtilUser, allowed_names: dict, exercise_map: dict) -> dict:
+# (freq key, day) pairs whose empty-after-tool-filtering fallback was already logged
+_EMPTY_TOOL_FALLBACKS_LOGGED = set()
+
+def _prepare_allowed_names(user: UtilUser, allowed_index: AllowedNames, exercise_map: dict) -> dict:
     """Filters the allowed names based on user's tools and level."""
-    final_allowed_names = json.loads(json.dumps(allowed_names)) # Start with a deep copy
-    pullupbar_exercises = set(allowed_names.get("TOOL", {}).get("PullUpBar", []))
+    allowed_names = allowed_index.raw
+    final_allowed_names = _copy_allowed_names(allowed_names)
+    pullupbar_exercises = allowed_index.tool_sets.get("PullUpBar", frozenset())
 
     # 1. Filter by selected tools
     if user.tools:
@@ -431,7 +874,9 @@ def _prepare_allowed_names(user: UtilUser, allowed_names: dict, exercise_map: di
                             new_sub_list.append(name)
                     
                     if not new_sub_list and sub_key not in ['ETC']:
-                        app.logger.warning(f"Empty exercise list for freq {key}, day {sub_key} after tool filtering. Falling back to unfiltered list.")
+                        if (key, sub_key) not in _EMPTY_TOOL_FALLBACKS_LOGGED:
+                            _EMPTY_TOOL_FALLBACKS_LOGGED.add((key, sub_key))
+                            app.logger.warning(f"Empty exercise list for freq {key}, day {sub_key} after tool filtering. Falling back to unfiltered list (logged once).")
                         new_sub_list = allowed_names.get(key, {}).get(sub_key, [])
                     
                     final_allowed_names[key][sub_key] = new_sub_list
@@ -462,8 +907,7 @@ def _prepare_allowed_names(user: UtilUser, allowed_names: dict, exercise_map: di
 
     # 3. Filter by level (Beginner/Novice)
     if user.level in ['Beginner', 'Novice']:
-        level_key = ('MBeginner' if user.gender == 'M' else 'FBeginner') if user.level == 'Beginner' else ('MNovice' if user.gender == 'M' else 'FNovice')
-        level_exercise_set = set(allowed_names.get(level_key, []))
+        level_exercise_set = allowed_index.level_set(user.level, user.gender)
         
         if str(user.freq) in final_allowed_names:
             for tag in final_allowed_names[str(user.freq)]:
@@ -485,18 +929,211 @@ def _prepare_allowed_names(user: UtilUser, allowed_names: dict, exercise_map: di
 
     return final_allowed_names
 
-def post_validate_and_fix_week(obj, exercise_map, freq=None, split_tags=None, allowed_names=None, level='Intermediate', duration=60, prevent_weekly_duplicates=True, prevent_category_duplicates=True):
-    if not isinstance(obj, dict) or "days" not in obj:
-        return obj
-
-    level_schema = EXERCISE_COUNT_SCHEMA.get(level, EXERCISE_COUNT_SCHEMA['Intermediate'])
-    duration_key = min(level_schema.keys(), key=lambda k: abs(k - duration) if k <= duration else float('inf'))
-    min_ex, max_ex = level_schema[duration_key]
+# --- Week Schema Cache ---
+
+@dataclass(frozen=True)
+class PreparedSchema:
+    allowed_names: dict  # Tool/level-filtered allowed names; shared, treat as read-only
+    schema: dict
+    schema_json: str  # Compact serialization sent as guided_json
+    schema_hash: str
+    day_indexes: Dict[str, "DayAllowedIndex"]
+    token_texts: Tuple[str, ...]  # Texts whose token counts the schema's max_tokens budget depends on
+
+class WeekSchemaCache:
+    """LRU cache of filtered allowed names and guided-decoding week schemas per configuration.
+
+    Entries are keyed by (freq, split tags, level, gender, tool subset, min_ex, catalog encoding,
+    output format) and are dropped whenever a new allowed-names index is loaded.
+    """
+
+    def __init__(self, maxsize: int = 2048):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._allowed_index = None
+
+    def get(self, user: UtilUser, split_tags: List[str], min_ex: int, max_ex: int, allowed_index: AllowedNames, catalog_view: CatalogView, catalog_encoding: str = "json", output_format: str = "pairs") -> PreparedSchema:
+        if allowed_index is not self._allowed_index:
+            self._entries.clear()
+            self._allowed_index = allowed_index
+
+        tools_key = frozenset(t.lower() for t in user.tools) if user.tools else frozenset()
+        key = (user.freq, tuple(split_tags), user.level, user.gender, tools_key, min_ex, catalog_encoding, output_format)
+        prepared = self._entries.get(key)
+        if prepared is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return prepared
+
+        self.misses += 1
+        with timed_stage("allowed_names"):
+            effective_allowed_names = _prepare_allowed_names(user, allowed_index, catalog_view.exercise_map)
+        with timed_stage("schema"):
+            week_schema = build_week_schema_by_name(user.freq, split_tags, effective_allowed_names, min_ex, max_ex, catalog_view.exercise_map, level=user.level, canonical=CANONICAL_SCHEMAS)
+            if catalog_encoding == "compact":
+                week_schema = encode_schema_exercise_ids(week_schema, CATALOG_CODES.exercise_ids, canonical=CANONICAL_SCHEMAS, bare=(output_format == "ids"))
+            if SCHEMA_REFS:
+                week_schema = dedupe_schema_enums(week_schema)
+            schema_json = serialize_schema(week_schema, canonical=CANONICAL_SCHEMAS)
+            token_texts = tuple(dict.fromkeys(schema_texts(week_schema)))
+        prepared = PreparedSchema(
+            allowed_names=effective_allowed_names,
+            schema=week_schema,
+            schema_json=schema_json,
+            schema_hash=hashlib.sha256(schema_json.encode('utf-8')).hexdigest(),
+            day_indexes={tag: build_day_allowed_index(tag, user.freq, effective_allowed_names, catalog_view.exercise_map) for tag in split_tags},
+            token_texts=token_texts,
+        )
+        self._entries[key] = prepared
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return prepared
+
+    def values(self) -> List[PreparedSchema]:
+        return list(self._entries.values())
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
 
-    weekly_used_names = set()
-    final_days = []
+# Canonical schemas are deterministic per configuration (see build_week_schema_by_name)
+CANONICAL_SCHEMAS = os.getenv("CANONICAL_SCHEMAS", "1") == "1"
+# Define repeated enums once under $defs; set to 0 for a guided-decoding backend without $ref support
+SCHEMA_REFS = os.getenv("SCHEMA_REFS", "1") == "1"
+
+# max_tokens derived from the week schema: every day has a fixed item count, so the longest
+# possible output is known. A tighter max_tokens lets vLLM reserve less KV cache per sequence.
+TOKEN_BUDGET_ENABLED = os.getenv("TOKEN_BUDGET_ENABLED", "1") == "1"
+TOKEN_BUDGET_MARGIN = float(os.getenv("TOKEN_BUDGET_MARGIN", "1.1"))
+TOKEN_BUDGET_SLACK = int(os.getenv("TOKEN_BUDGET_SLACK", "16"))
+# Whitespace tokens allowed next to each bracket, comma and colon; the guided grammar permits them
+TOKEN_BUDGET_WHITESPACE = int(os.getenv("TOKEN_BUDGET_WHITESPACE", "1"))
+# Counts come from vLLM's /tokenize endpoint; max_tokens is only capped once every count a schema
+# needs has been fetched, never on the character-based estimate.
+TOKEN_COUNTER = TokenCounter(VLLM_MODEL, tokenize_url=os.getenv("TOKEN_BUDGET_TOKENIZE_URL", VLLM_BASE_URL.rstrip('/').removesuffix('/v1') + "/tokenize"))
+WEEK_SCHEMA_CACHE = WeekSchemaCache(maxsize=int(os.getenv("SCHEMA_CACHE_SIZE", "2048")))
+# Filled in the lifespan hook, so importing this module stays cheap
+SCHEMA_CACHE_PREWARM = os.getenv("SCHEMA_CACHE_PREWARM", "1") == "1"
+
+# Tool selections sent by the web UI (all boxes checked) and by src/finetuning/run_tests.py
+PREWARM_TOOL_SETS = [
+    ["Barbell", "Dumbbell", "Machine", "Bodyweight", "Kettlebell", "EZbar", "Etc", "PullUpBar"],
+    ["Barbell", "Dumbbell", "Machine", "Bodyweight", "EZbar", "Etc", "PullUpBar"],
+]
+
+def prewarm_week_schema_cache():
+    """Builds the schemas for every level, gender, split and duration with the common tool selections."""
+    started = time.perf_counter()
+    allowed_index = get_allowed_names()
+    for level, durations in EXERCISE_COUNT_SCHEMA.items():
+        for gender in ('M', 'F'):
+            catalog_view = get_catalog_view(level, gender)
+            for freq, split_options in SPLIT_CONFIGS.items():
+                for split_config in split_options:
+                    for tools in PREWARM_TOOL_SETS:
+                        for min_ex, max_ex in set(durations.values()):
+                            user = UtilUser(gender=gender, weight=0, level=level, freq=int(freq), duration=0, intensity='', tools=tools)
+                            WEEK_SCHEMA_CACHE.get(user, split_config['days'], min_ex, max_ex, allowed_index, catalog_view, *resolve_output_encoding())
+    app.logger.info(f"Pre-warmed {WEEK_SCHEMA_CACHE.stats()['size']} week schemas in {time.perf_counter() - started:.2f}s")
+
+async def prewarm_token_counts():
+    """Fetches the token counts of every cached schema, so early requests need no /tokenize calls."""
+    started = time.perf_counter()
+    texts = {text for prepared in WEEK_SCHEMA_CACHE.values() for text in prepared.token_texts}
+    if await TOKEN_COUNTER.fetch(texts):
+        app.logger.info(f"Fetched token counts for {len(texts)} schema values in {time.perf_counter() - started:.2f}s")
+    else:
+        app.logger.warning(f"Token counts unavailable ({TOKEN_COUNTER.load_error}); max_tokens stays uncapped until {TOKEN_COUNTER.tokenize_url} answers")
+
+@dataclass(frozen=True)
+class DayAllowedIndex:
+    """A day's allowed exercise names for category de-duplication, in allowed-list order."""
+    names: List[str]
+    by_bp: Dict[str, List[str]]
+    category_of: Dict[str, str]
+
+def build_day_allowed_index(tag, freq, allowed_names, exercise_map) -> DayAllowedIndex:
+    if tag.startswith("FULLBODY"):
+        all_body_part_keys = ['CHEST', 'BACK', 'SHOULDERS', 'LEGS', 'ARM', 'ABS', 'CARDIO', 'ETC']
+        all_fullbody_exercises = set()
+        for key in all_body_part_keys:
+            if key in allowed_names and isinstance(allowed_names[key], list):
+                all_fullbody_exercises.update(allowed_names[key])
+
+        names = list(all_fullbody_exercises)
+        if not names:
+            app.logger.warning("No exercises found in top-level body part lists for post-validation. Falling back.")
+            names = list(exercise_map.keys())
+    else:
+        try:
+            names = allowed_names[str(freq)][tag]
+        except KeyError:
+            app.logger.warning(f"No allowed_names found for freq {freq}, tag {tag}. Falling back to all exercises.")
+            names = list(exercise_map.keys())
+
+    by_bp = {}
+    category_of = {}
+    for name in names:
+        ex = exercise_map.get(name, {})
+        by_bp.setdefault(ex.get('bName'), []).append(name)
+        category_of[name] = ex.get('category')
+    return DayAllowedIndex(names=names, by_bp=by_bp, category_of=category_of)
+
+class WeekFixer:
+    """Post-validates a week one day at a time.
+
+    Days must be fed in order: each day is checked against the exercises already used earlier
+    in the week, so a streamed response can be fixed as soon as each day is complete.
+    """
+
+    def __init__(self, exercise_map, freq=None, split_tags=None, allowed_names=None, prevent_weekly_duplicates=True, prevent_category_duplicates=True, candidate_index=None, day_indexes=None, rng=None):
+        self.exercise_map = exercise_map
+        self.rng = rng or random
+        self.candidate_index = candidate_index or build_candidate_index(exercise_map)
+        self.day_indexes = dict(day_indexes or {})
+        self.freq = freq
+        self.split_tags = split_tags
+        self.allowed_names = allowed_names
+        self.prevent_weekly_duplicates = prevent_weekly_duplicates
+        self.prevent_category_duplicates = prevent_category_duplicates
+        self.weekly_used_names = set()
+        # Repairs made so far, used to score best-of-N candidates; published by record_metrics()
+        self.fixes = {"dropped": 0, "main_ex": 0, "dedupe": 0, "category_dedupe": 0}
+
+    def _record_fix(self, kind: str, count: int = 1):
+        self.fixes[kind] += count
+
+    def record_metrics(self):
+        """Adds this week's repairs to FIXES_TOTAL. Call it only for the routine actually returned."""
+        for kind, count in self.fixes.items():
+            if count:
+                FIXES_TOTAL.inc(count, kind=kind)
+
+    def day_allowed_index(self, tag) -> DayAllowedIndex:
+        day_index = self.day_indexes.get(tag)
+        if day_index is None:
+            day_index = build_day_allowed_index(tag, self.freq, self.allowed_names, self.exercise_map)
+            self.day_indexes[tag] = day_index
+        return day_index
+
+    def fix_day(self, day_idx, day_exercises):
+        exercise_map = self.exercise_map
+        freq = self.freq
+        split_tags = self.split_tags
+        allowed_names = self.allowed_names
+        prevent_weekly_duplicates = self.prevent_weekly_duplicates
+        prevent_category_duplicates = self.prevent_category_duplicates
+        weekly_used_names = self.weekly_used_names
+        candidate_index = self.candidate_index
 
-    for day_idx, day_exercises in enumerate(obj.get("days", [])):
         current_day_fixed = []
         temp_used_names = set()
         if isinstance(day_exercises, list):
@@ -512,6 +1149,8 @@ def post_validate_and_fix_week(obj, exercise_map, freq=None, split_tags=None, al
                 cat_bp = exercise.get('bName') or bp_clean
                 current_day_fixed.append([cat_bp, ex_name])
                 temp_used_names.add(ex_name)
+            if len(current_day_fixed) < len(day_exercises):
+                self._record_fix("dropped", len(day_exercises) - len(current_day_fixed))
 
         tag = split_tags[day_idx % len(split_tags)]
         main_exercise_requirements = []
@@ -544,8 +1183,8 @@ def post_validate_and_fix_week(obj, exercise_map, freq=None, split_tags=None, al
         if main_exercise_requirements:
             day_names = {p[1] for p in current_day_fixed}
             for bp in main_exercise_requirements:
-                main_exercises_for_bp = [name for name, ex in exercise_map.items() if ex.get('bName') == bp and ex.get('main_ex')]
-                has_main = any(ex_name in day_names for ex_name in main_exercises_for_bp)
+                main_exercises_for_bp = candidate_index.main_by_bp.get(bp, [])
+                has_main = not day_names.isdisjoint(candidate_index.main_sets.get(bp, frozenset()))
 
                 if not has_main:
                     replacement_main_ex = next((ex for ex in main_exercises_for_bp if ex not in day_names and ex not in weekly_used_names), None)
@@ -573,56 +1212,49 @@ def post_validate_and_fix_week(obj, exercise_map, freq=None, split_tags=None, al
                         original_to_replace = current_day_fixed[replace_idx]
                         app.logger.info(f"[MainEx Fix] Day {day_idx+1} ({tag}): Swapping '{original_to_replace[1]}' with '{replacement_main_ex}' for {bp}")
                         current_day_fixed[replace_idx] = [bp, replacement_main_ex]
+                        self._record_fix("main_ex")
                         day_names = {p[1] for p in current_day_fixed} # Refresh names
 
             day_names = {name for _, name in current_day_fixed}
             deduped_day = []
+            deduped_names = set()
             for bp, name in current_day_fixed:
                 if name in weekly_used_names:
                     original_ex_info = exercise_map.get(name, {})
                     is_main = original_ex_info.get('main_ex', False)
                     
-                    other_day_names = day_names - {name}
-                    candidates = [cand_name for cand_name, cand_ex in exercise_map.items() if 
-                                cand_ex.get('bName') == bp and 
-                                cand_ex.get('main_ex', False) == is_main and 
-                                cand_name not in weekly_used_names and 
-                                cand_name not in other_day_names and
-                                cand_name not in {p[1] for p in deduped_day}]
+                    candidates = [cand_name for cand_name in candidate_index.by_bp_and_main.get((bp, is_main), []) if
+                                cand_name not in weekly_used_names and
+                                (cand_name == name or cand_name not in day_names) and
+                                cand_name not in deduped_names]
                     
                     if candidates:
-                        replacement = random.choice(candidates)
-                        deduped_day.append([bp, replacement])
+                        replacement = self.rng.choice(candidates)
                         app.logger.info(f"[De-Dupe] Day {day_idx+1}: Swapping duplicate '{name}' with '{replacement}'")
+                        self._record_fix("dedupe")
                     else:
-                        deduped_day.append([bp, name])
+                        replacement = name
                 else:
-                    deduped_day.append([bp, name])
+                    replacement = name
+                deduped_day.append([bp, replacement])
+                deduped_names.add(replacement)
             current_day_fixed = deduped_day
 
         if prevent_category_duplicates:
             categories_used_today = set()
             category_deduped_day = []
+            category_deduped_names = set()
             day_names = {name for _, name in current_day_fixed}
             
-            current_day_allowed_names = []
-            if tag.startswith("FULLBODY"):
-                all_body_part_keys = ['CHEST', 'BACK', 'SHOULDERS', 'LEGS', 'ARM', 'ABS', 'CARDIO', 'ETC']
-                all_fullbody_exercises = set()
-                for key in all_body_part_keys:
-                    if key in allowed_names and isinstance(allowed_names[key], list):
-                        all_fullbody_exercises.update(allowed_names[key])
-                
-                current_day_allowed_names = list(all_fullbody_exercises)
-                if not current_day_allowed_names:
-                    app.logger.warning("No exercises found in top-level body part lists for post-validation. Falling back.")
-                    current_day_allowed_names = list(exercise_map.keys())
-            else:
-                try:
-                    current_day_allowed_names = allowed_names[str(freq)][tag]
-                except KeyError:
-                    app.logger.warning(f"No allowed_names found for freq {freq}, tag {tag}. Falling back to all exercises.")
-                    current_day_allowed_names = list(exercise_map.keys())
+            day_index = self.day_allowed_index(tag)
+            category_of = day_index.category_of
+
+            def is_available(cand_name):
+                # day_names includes the exercise being replaced, so it is never its own candidate
+                return (category_of[cand_name] not in categories_used_today and
+                        (not prevent_weekly_duplicates or cand_name not in weekly_used_names) and
+                        cand_name not in day_names and
+                        cand_name not in category_deduped_names)
 
             for bp, name in current_day_fixed:
                 exercise_info = exercise_map.get(name, {})
@@ -631,50 +1263,28 @@ def post_validate_and_fix_week(obj, exercise_map, freq=None, split_tags=None, al
                 if category and category != '(Uncategorized)' and category in categories_used_today:
                     app.logger.info(f"[Category De-Dupe] Day {day_idx+1}: Category '{category}' for '{name}' already used. Attempting replacement.")
                     
-                    other_day_names = day_names - {name}
-                    strict_candidates = []
-                    for cand_name in current_day_allowed_names:
-                        cand_ex_info = exercise_map.get(cand_name, {})
-                        cand_category = cand_ex_info.get('category')
-                        cand_bp = cand_ex_info.get('bName')
-
-                        if (cand_bp == bp and
-                            cand_category not in categories_used_today and
-                            (not prevent_weekly_duplicates or cand_name not in weekly_used_names) and
-                            cand_name not in other_day_names and
-                            cand_name not in {p[1] for p in category_deduped_day} and
-                            cand_name != name):
-                            strict_candidates.append(cand_name)
-                    
-                    candidates = strict_candidates
+                    candidates = [cand_name for cand_name in day_index.by_bp.get(bp, []) if is_available(cand_name)]
 
                     if not candidates:
-                        relaxed_candidates = []
-                        for cand_name in current_day_allowed_names:
-                            cand_ex_info = exercise_map.get(cand_name, {})
-                            cand_category = cand_ex_info.get('category')
-
-                            if (cand_category not in categories_used_today and
-                                (not prevent_weekly_duplicates or cand_name not in weekly_used_names) and
-                                cand_name not in other_day_names and
-                                cand_name not in {p[1] for p in category_deduped_day} and
-                                cand_name != name):
-                                relaxed_candidates.append(cand_name)
-                        candidates = relaxed_candidates
+                        candidates = [cand_name for cand_name in day_index.names if is_available(cand_name)]
                     
                     if candidates:
-                        replacement = random.choice(candidates)
+                        replacement = self.rng.choice(candidates)
                         category_deduped_day.append([bp, replacement])
+                        category_deduped_names.add(replacement)
                         categories_used_today.add(exercise_map.get(replacement, {}).get('category'))
                         if prevent_weekly_duplicates:
                             weekly_used_names.add(replacement)
+                        self._record_fix("category_dedupe")
                         app.logger.info(f"[Category De-Dupe] Day {day_idx+1}: Swapped '{name}' (Category: {category}) with '{replacement}' (Category: {exercise_map.get(replacement, {}).get('category')})")
                     else:
                         category_deduped_day.append([bp, name])
+                        category_deduped_names.add(name)
                         categories_used_today.add(category)
                         app.logger.warning(f"[Category De-Dupe] Day {day_idx+1}: No suitable replacement found for '{name}' (Category: {category}). Keeping original.")
                 else:
                     category_deduped_day.append([bp, name])
+                    category_deduped_names.add(name)
                     if category:
                         categories_used_today.add(category)
             current_day_fixed = category_deduped_day
@@ -682,27 +1292,106 @@ def post_validate_and_fix_week(obj, exercise_map, freq=None, split_tags=None, al
         for _, name in current_day_fixed:
             weekly_used_names.add(name)
         
-        final_days.append(current_day_fixed)
+        return current_day_fixed
 
-    return {"days": final_days}
+def post_validate_and_fix_week(obj, exercise_map, freq=None, split_tags=None, allowed_names=None, level='Intermediate', duration=60, prevent_weekly_duplicates=True, prevent_category_duplicates=True, rng=None):
+    if not isinstance(obj, dict) or "days" not in obj:
+        return obj
 
-# --- API Endpoints ---
+    fixer = WeekFixer(
+        exercise_map,
+        freq=freq,
+        split_tags=split_tags,
+        allowed_names=allowed_names,
+        prevent_weekly_duplicates=prevent_weekly_duplicates,
+        prevent_category_duplicates=prevent_category_duplicates,
+        rng=rng,
+    )
+    final_days = []
+    for day_idx, day_exercises in enumerate(obj.get("days", [])):
+        final_days.append(fixer.fix_day(day_idx, day_exercises))
+    fixer.record_metrics()
 
-@app.get("/api/ratios", summary="Get exercise ratio weights")
-async def get_ratios_api():
-    return JSONResponse(content={
-        "M_ratio_weight": M_ratio_weight,
-        "F_ratio_weight": F_ratio_weight
-    })
+    return {"days": final_days}
 
-@app.get("/api/exercises", summary="Get full exercise catalog")
-async def get_exercises_api():
-    if not exercise_catalog:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Exercise catalog not found or failed to load.")
-    return JSONResponse(content=exercise_catalog)
+# --- Precomputed Catalog Payloads ---
+
+CATALOG_MANIFEST_KEEP = int(os.getenv("CATALOG_MANIFEST_KEEP", "20"))
+_VERSION_RE = re.compile(r"[0-9a-f]{16}")
+
+def _exercise_item_hash(item: dict) -> str:
+    return hashlib.sha256(json.dumps(item, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+class CatalogVersions:
+    """Serves the exercise catalog as a precompressed payload, plus deltas against earlier versions.
+
+    Each catalog version's per-exercise hashes are written to CATALOG_MANIFEST_DIR (by write_manifest,
+    called at startup), so a client holding a version from a previous deploy can download only the
+    exercises that changed.
+    """
+
+    def __init__(self, catalog: list, manifest_dir: str, keep: int = 20):
+        self.catalog = catalog
+        self.manifest_dir = manifest_dir
+        self.keep = keep
+        self.item_hashes = {item.get('eName'): _exercise_item_hash(item) for item in catalog if item.get('eName')}
+        self.version = hashlib.sha256("\n".join(f"{name}:{h}" for name, h in sorted(self.item_hashes.items())).encode('utf-8')).hexdigest()[:16]
+        self.full = PrecompressedPayload(jsonio.dumps(catalog).encode('utf-8'), version=self.version)
+        self._deltas: Dict[str, PrecompressedPayload] = {}
+
+    def _manifest_path(self, version: str) -> str:
+        return os.path.join(self.manifest_dir, f"{version}.json")
+
+    def write_manifest(self):
+        try:
+            os.makedirs(self.manifest_dir, exist_ok=True)
+            path = self._manifest_path(self.version)
+            if not os.path.exists(path):
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(self.item_hashes, f, ensure_ascii=False)
+            manifests = sorted((entry for entry in os.scandir(self.manifest_dir) if entry.name.endswith('.json')), key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for stale in manifests[self.keep:]:
+                os.remove(stale.path)
+        except OSError as e:
+            app.logger.warning(f"Could not write catalog manifest to {self.manifest_dir}; ?since= will return full catalogs: {e}")
+
+    def _load_manifest(self, version: str) -> Optional[dict]:
+        if not _VERSION_RE.fullmatch(version):
+            return None
+        try:
+            with open(self._manifest_path(version), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def delta(self, since: str) -> PrecompressedPayload:
+        old_hashes = self.item_hashes if since == self.version else self._load_manifest(since)
+        # Unknown versions share one payload in which the client replaces its copy with the full catalog
+        key = since if old_hashes is not None else "full"
+        payload = self._deltas.get(key)
+        if payload is not None:
+            return payload
+
+        if old_hashes is None:
+            body = {"version": self.version, "full": True, "changed": self.catalog, "removed": []}
+        else:
+            body = {
+                "version": self.version,
+                "full": False,
+                "changed": [item for item in self.catalog if old_hashes.get(item.get('eName')) != self.item_hashes.get(item.get('eName'))],
+                "removed": sorted(name for name in old_hashes if name not in self.item_hashes),
+            }
+        payload = PrecompressedPayload(jsonio.dumps(body).encode('utf-8'), version=f"{self.version}-{key}")
+        self._deltas[key] = payload
+        return payload
 
-@app.get("/api/similar-exercises/{exercise_name}", summary="Get similar exercises for a given exercise")
-async def get_similar_exercises_api(exercise_name: str):
+CATALOG_VERSIONS = CatalogVersions(exercise_catalog, CATALOG_MANIFEST_DIR, keep=CATALOG_MANIFEST_KEEP)
+RATIOS_PAYLOAD = PrecompressedPayload(jsonio.dumps({
+    "M_ratio_weight": M_ratio_weight,
+    "F_ratio_weight": F_ratio_weight
+}).encode('utf-8'))
+
+def resolve_similar_exercises(exercise_name: str) -> list:
     similar_exercises_en = exercise_similarity_map.get(exercise_name)
 
     if not similar_exercises_en:
@@ -712,11 +1401,8 @@ async def get_similar_exercises_api(exercise_name: str):
             # If it is, get the similar exercises of the first main exercise
             similar_exercises_en = exercise_similarity_map.get(main_exercises[0])
 
-    if not similar_exercises_en:
-        return JSONResponse(content=[])
-
     similar_exercises_ko = []
-    for en_name in similar_exercises_en:
+    for en_name in similar_exercises_en or []:
         exercise_details = name_to_exercise_map.get(en_name)
         if exercise_details:
             similar_exercises_ko.append({
@@ -724,8 +1410,104 @@ async def get_similar_exercises_api(exercise_name: str):
                 "kName": exercise_details.get("kName", en_name),
                 "bName": exercise_details.get("bName", "N/A")
             })
+    return similar_exercises_ko
+
+# Serialized similar-exercise lists for every name that has any; other names get EMPTY_JSON_LIST
+EMPTY_JSON_LIST = b"[]"
+SIMILAR_EXERCISE_BODIES: Dict[str, bytes] = {
+    name: jsonio.dumps(resolve_similar_exercises(name)).encode('utf-8')
+    for name in set(exercise_similarity_map) | set(similar_to_main_map)
+}
+
+# --- API Endpoints ---
+
+@app.middleware("http")
+async def server_timing_middleware(request: Request, call_next):
+    """Echoes the per-stage timings recorded while handling the request in a Server-Timing header."""
+    timings = start_request_timings()
+    started = time.perf_counter()
+    response = await call_next(request)
+    if timings:
+        timings.append(("total", time.perf_counter() - started))
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+# Profiling is off unless PROFILE_TOKEN is set; callers must send it as X-Profile-Token
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILED_PATHS = {"/api/infer", "/api/generate-prompt"}
+_profile_lock = asyncio.Lock()
+
+@app.middleware("http")
+async def profiling_middleware(request: Request, call_next):
+    """Runs a single request under the profiler when it carries `X-Profile: 1` and the admin token.
+
+    Artifacts are written to PROFILE_DIR and their file names returned in X-Profile-Artifacts.
+    Without a valid token the header is ignored and the request is served normally.
+    Only one request is profiled at a time; concurrent ones run normally with X-Profile-Skipped.
+    """
+    if request.headers.get("X-Profile") != "1" or request.url.path not in PROFILED_PATHS:
+        return await call_next(request)
+
+    token = request.headers.get("X-Profile-Token", "")
+    if not PROFILE_TOKEN or not hmac.compare_digest(token.encode('utf-8'), PROFILE_TOKEN.encode('utf-8')):
+        return await call_next(request)
+
+    if _profile_lock.locked():
+        response = await call_next(request)
+        response.headers["X-Profile-Skipped"] = "busy"
+        return response
+
+    async with _profile_lock:
+        with profile_to_dir(PROFILE_DIR, request.url.path) as capture:
+            response = await call_next(request)
+    artifact_names = [os.path.basename(path) for path in capture.artifacts]
+    app.logger.info(f"Profiled {request.url.path}: {', '.join(capture.artifacts)}")
+    response.headers["X-Profile-Artifacts"] = ", ".join(artifact_names)
+    return response
+
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+async def get_metrics_api():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/ratios", summary="Get exercise ratio weights")
+async def get_ratios_api(request: Request):
+    return RATIOS_PAYLOAD.response(request)
+
+@app.get("/api/exercises", summary="Get full exercise catalog")
+async def get_exercises_api(request: Request, since: Optional[str] = None):
+    """Returns the catalog list, or with ?since=<version> a delta
+    {version, full, changed, removed}. The current version is sent in X-Catalog-Version."""
+    if not exercise_catalog:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Exercise catalog not found or failed to load.")
+    payload = CATALOG_VERSIONS.full if since is None else CATALOG_VERSIONS.delta(since)
+    return payload.response(request, headers={"X-Catalog-Version": CATALOG_VERSIONS.version})
+
+@app.get("/api/cache-stats", summary="Get hit/miss statistics for the server-side caches")
+async def get_cache_stats_api():
+    response_cache_stats = await asyncio.to_thread(RESPONSE_CACHE.stats) if RESPONSE_CACHE is not None else None
+    return FastJSONResponse(content={
+        "prompt_catalog": CATALOG_FRAGMENT_CACHE.stats(),
+        "week_schema": WEEK_SCHEMA_CACHE.stats(),
+        "coalescing": IN_FLIGHT_REQUESTS.stats(),
+        "idempotency": IDEMPOTENCY_STORE.stats(),
+        "responses": response_cache_stats,
+        "token_budget": {"enabled": TOKEN_BUDGET_ENABLED, "counter": TOKEN_COUNTER.backend, "counter_available": TOKEN_COUNTER.available, "load_error": TOKEN_COUNTER.load_error},
+    })
 
-    return JSONResponse(content=similar_exercises_ko)
+@app.get("/api/similar-exercises/{exercise_name}", summary="Get similar exercises for a given exercise")
+async def get_similar_exercises_api(exercise_name: str):
+    return Response(content=SIMILAR_EXERCISE_BODIES.get(exercise_name, EMPTY_JSON_LIST), media_type="application/json")
+
+@app.post("/api/similar-exercises", summary="Get similar exercises for many exercises in one request")
+async def get_similar_exercises_bulk_api(body: SimilarExercisesRequest):
+    """Returns {exercise_name: [similar exercises]} for every requested name, e.g. a whole routine."""
+    names = list(dict.fromkeys(body.names))
+    # Splices the precomputed bodies together instead of re-serializing them
+    content = b"{" + b",".join(
+        jsonio.dumps(name).encode('utf-8') + b":" + SIMILAR_EXERCISE_BODIES.get(name, EMPTY_JSON_LIST)
+        for name in names
+    ) + b"}"
+    return Response(content=content, media_type="application/json")
 
 @app.post("/api/generate-prompt", summary="Generate a workout prompt based on user configuration")
 async def generate_prompt_api(config: UserConfig):
@@ -733,32 +1515,8 @@ async def generate_prompt_api(config: UserConfig):
         user, min_ex, max_ex = get_user_config_from_model(config)
         duration_str = str(config.duration)
 
-        with open(os.path.join(os.path.dirname(__file__), "allowed_name_200.json"), "r", encoding="utf-8") as f:
-            ALLOWED_NAMES = json.load(f)
-
-        if user.level == 'Beginner':
-            level_key = 'MBeginner' if user.gender == 'M' else 'FBeginner'
-            level_specific_set = set(ALLOWED_NAMES.get(level_key, []))
-        elif user.level == 'Novice':
-            level_key = 'MNovice' if user.gender == 'M' else 'FNovice'
-            level_specific_set = set(ALLOWED_NAMES.get(level_key, []))
-        else:
-            level_specific_set = None
-
-        if level_specific_set is not None:
-            MODIFIED_ALLOWED_NAMES = json.loads(json.dumps(ALLOWED_NAMES))
-            if str(user.freq) in MODIFIED_ALLOWED_NAMES:
-                for tag in MODIFIED_ALLOWED_NAMES[str(user.freq)]:
-                    original_exercises = MODIFIED_ALLOWED_NAMES[str(user.freq)][tag]
-                    intersected_exercises = list(level_specific_set.intersection(original_exercises))
-                    if not intersected_exercises:
-                        freq_union = [ex for t, ex_list in MODIFIED_ALLOWED_NAMES[str(user.freq)].items() if t != tag for ex in ex_list]
-                        safe_intersection = list(level_specific_set.intersection(freq_union))
-                        intersected_exercises = safe_intersection if safe_intersection else list(level_specific_set)
-                    MODIFIED_ALLOWED_NAMES[str(user.freq)][tag] = intersected_exercises
-            effective_allowed_names = MODIFIED_ALLOWED_NAMES
-        else:
-            effective_allowed_names = ALLOWED_NAMES
+        # build_prompt only reads the TOOL and level lists, so the shared index is passed as-is
+        ALLOWED_NAMES = get_allowed_names().raw
 
         split_options = SPLIT_CONFIGS.get(str(user.freq), [])
         split_config = next((c for c in split_options if c['id'] == config.split_id), None)
@@ -766,63 +1524,74 @@ async def generate_prompt_api(config: UserConfig):
         if not split_config:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid split_id '{config.split_id}' for frequency {user.freq}")
 
-        prompt = build_prompt(user, exercise_catalog, duration_str, min_ex, max_ex, split_config, allowed_names=effective_allowed_names)
-        return JSONResponse(content={"prompt": prompt})
+        catalog_encoding, output_format = resolve_output_encoding(config.catalog_encoding, config.output_format)
+        prompt = build_prompt(user, exercise_catalog, duration_str, min_ex, max_ex, split_config, allowed_names=ALLOWED_NAMES, rng=request_rng(config), layout=config.prompt_layout, catalog_encoding=catalog_encoding, codes=CATALOG_CODES, output_format=output_format)
+        return FastJSONResponse(content={"prompt": prompt})
     except Exception as e:
         app.logger.error(f"Error in generate_prompt_api: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred: {str(e)}")
 
-async def process_inference_request(config: UserConfig, client_creator):
+@dataclass(frozen=True)
+class InferenceContext:
+    user: UtilUser
+    min_ex: int
+    max_ex: int
+    catalog_view: CatalogView
+    split_tags: List[str]
+    prepared_schema: PreparedSchema
+    prompt: Optional[str]  # None for the solver backend, which needs no prompt
+    exercise_names_by_id: Optional[Mapping[int, str]] = None  # Set when the model answers with exercise IDs
+
+def prepare_inference_context(config: UserConfig, rng: random.Random, solver: bool = False) -> InferenceContext:
+    """Resolves everything needed before the backend call: catalog view, prompt and week schema.
+
+    With solver=True no prompt is built and the schema always uses exercise names.
+    """
     user, min_ex, max_ex = get_user_config_from_model(config)
-    prevent_weekly_duplicates = config.prevent_weekly_duplicates
-    prevent_category_duplicates = config.prevent_category_duplicates
-
-    with open(os.path.join(os.path.dirname(__file__), "allowed_name_200.json"), "r", encoding="utf-8") as f:
-        ALLOWED_NAMES = json.load(f)
-
-    # Create a request-specific catalog AND map to handle dynamic main_ex flags
-    request_catalog = json.loads(json.dumps(exercise_catalog))
-    request_name_to_exercise_map = {ex.get('eName'): ex for ex in request_catalog}
-
-    if user.level == 'Beginner':
-        app.logger.info("Applying Beginner main leg exercise rule...")
-        beginner_main_legs = {"Leg Press", "Dumbbell Lunge", "Smith Machine Squat", "Dumbbell Goblet Squat", "Air Squat"}
-        for exercise in request_catalog:
-            if exercise.get('bName') == 'Leg':
-                is_beginner_main_leg = exercise.get('eName') in beginner_main_legs
-                original_main_status = exercise.get('main_ex', False)
-                if original_main_status != is_beginner_main_leg:
-                    exercise['main_ex'] = is_beginner_main_leg
-                    # Also update the temporary map
-                    if exercise.get('eName') in request_name_to_exercise_map:
-                        request_name_to_exercise_map[exercise.get('eName')]['main_ex'] = is_beginner_main_leg
-                    action = "promoting" if is_beginner_main_leg else "demoting"
-
-    if not config.prompt:
-        duration_str = str(config.duration)
-        split_options = SPLIT_CONFIGS.get(str(user.freq), [])
-        split_config = next((c for c in split_options if c['id'] == config.split_id), None)
-        if not split_config:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid split_id '{config.split_id}' for frequency {user.freq}")
-        prompt = build_prompt(user, request_catalog, duration_str, min_ex, max_ex, split_config, allowed_names=ALLOWED_NAMES)
-    else:
-        prompt = config.prompt
-    
+
+    allowed_index = get_allowed_names()
+    ALLOWED_NAMES = allowed_index.raw
+
+    # Shared, read-only catalog view with level-specific main_ex flags already applied
+    catalog_view = get_catalog_view(user.level, user.gender)
+    request_catalog = catalog_view.catalog
+
     split_options = SPLIT_CONFIGS.get(str(user.freq), [])
     split_config = next((c for c in split_options if c['id'] == config.split_id), None)
     if not split_config:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid split_id '{config.split_id}' for frequency {user.freq}")
     split_tags = split_config['days']
-    
-    effective_allowed_names = _prepare_allowed_names(user, ALLOWED_NAMES, request_name_to_exercise_map)
-    
-    week_schema = build_week_schema_by_name(user.freq, split_tags, effective_allowed_names, min_ex, max_ex, request_name_to_exercise_map, level=user.level)
+    if solver:
+        catalog_encoding, output_format = "json", "pairs"
+    else:
+        catalog_encoding, output_format = resolve_output_encoding(config.catalog_encoding, config.output_format)
 
-    client, model_name, completer = client_creator()
-    
+    if solver:
+        prompt = None
+    elif not config.prompt:
+        duration_str = str(config.duration)
+        with timed_stage("prompt"):
+            prompt = build_prompt(user, request_catalog, duration_str, min_ex, max_ex, split_config, allowed_names=ALLOWED_NAMES, rng=rng, layout=config.prompt_layout, catalog_encoding=catalog_encoding, codes=CATALOG_CODES, output_format=output_format)
+    else:
+        prompt = config.prompt
+
+    prepared_schema = WEEK_SCHEMA_CACHE.get(user, split_tags, min_ex, max_ex, allowed_index, catalog_view, catalog_encoding, output_format)
+
+    return InferenceContext(
+        user=user,
+        min_ex=min_ex,
+        max_ex=max_ex,
+        catalog_view=catalog_view,
+        split_tags=split_tags,
+        prepared_schema=prepared_schema,
+        prompt=prompt,
+        exercise_names_by_id=EXERCISE_NAMES_BY_ID if catalog_encoding == "compact" else None,
+    )
+
+async def call_backend(completer, **kwargs):
+    """Awaits a completer, translating backend failures into HTTPExceptions."""
     try:
-        resp = await completer(prompt=prompt, week_schema=week_schema, max_tokens=config.max_tokens, temperature=config.temperature)
-        raw = getattr(resp.choices[0].message, "content", None) or ""
+        return await completer(**kwargs)
     except openai.APIConnectionError as e:
         app.logger.error(f"OpenAI API connection error: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Failed to connect to AI model: {e}")
@@ -832,94 +1601,676 @@ async def process_inference_request(config: UserConfig, client_creator):
     except Exception as e:
         app.logger.error(f"Error during AI model inference: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"AI model inference failed: {e}")
-    
-    try:
-        obj = json.loads(json_repair_str(raw))
-    except json.JSONDecodeError as e:
-        app.logger.error(f"JSON repair/decode error: {e}. Raw response: {raw}", exc_info=True)
-        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"AI model returned invalid JSON: {e}")
 
-    if "days" not in obj:
+def parse_model_output(raw: str) -> dict:
+    """Parses model output strictly first; guided decoding almost always yields valid JSON,
+    so json_repair only runs when the strict parse fails."""
+    with timed_stage("parse"):
+        try:
+            obj = jsonio.loads(raw)
+            OUTPUT_PARSE_TOTAL.inc(path="strict")
+        except jsonio.JSONDecodeError:
+            try:
+                obj = json.loads(json_repair_str(raw))
+                OUTPUT_PARSE_TOTAL.inc(path="repaired")
+            except json.JSONDecodeError as e:
+                OUTPUT_PARSE_TOTAL.inc(path="failed")
+                app.logger.error(f"JSON repair/decode error: {e}. Raw response: {raw}", exc_info=True)
+                raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"AI model returned invalid JSON: {e}")
+
+    if not isinstance(obj, dict) or "days" not in obj:
         app.logger.error(f"Parsed object missing 'days'. Raw response: {raw}")
         raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="AI model response missing 'days' key.")
-    
-    processed_obj = post_validate_and_fix_week(
-        json.loads(json.dumps(obj)),
-        exercise_map=request_name_to_exercise_map,
-        freq=user.freq, 
-        split_tags=split_tags, 
-        allowed_names=effective_allowed_names, 
-        level=user.level, 
-        duration=user.duration, 
-        prevent_weekly_duplicates=prevent_weekly_duplicates,
-        prevent_category_duplicates=prevent_category_duplicates
+    return obj
+
+def _is_exercise_id(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def decode_exercise_ids(day_exercises, names_by_id: Optional[Mapping[int, str]], exercise_map: Mapping[str, Mapping]):
+    """Maps [bodypart, ID] items and bare IDs back to [bodypart, eName].
+
+    Bare IDs take their bodypart from the catalog. Unknown IDs become names the fixer drops.
+    """
+    if names_by_id is None or not isinstance(day_exercises, list):
+        return day_exercises
+    decoded = []
+    for item in day_exercises:
+        if _is_exercise_id(item):
+            name = names_by_id.get(item, str(item))
+            item = [exercise_map.get(name, {}).get('bName', ''), name]
+        elif isinstance(item, list) and len(item) == 2 and _is_exercise_id(item[1]):
+            item = [item[0], names_by_id.get(item[1], str(item[1]))]
+        decoded.append(item)
+    return decoded
+
+def decode_week(obj: dict, ctx: InferenceContext) -> dict:
+    if ctx.exercise_names_by_id is None or not isinstance(obj.get("days"), list):
+        return obj
+    return {**obj, "days": [decode_exercise_ids(day, ctx.exercise_names_by_id, ctx.catalog_view.exercise_map) for day in obj["days"]]}
+
+def make_week_fixer(config: UserConfig, ctx: InferenceContext, rng: random.Random) -> WeekFixer:
+    return WeekFixer(
+        ctx.catalog_view.exercise_map,
+        freq=ctx.user.freq,
+        split_tags=ctx.split_tags,
+        allowed_names=ctx.prepared_schema.allowed_names,
+        prevent_weekly_duplicates=config.prevent_weekly_duplicates,
+        prevent_category_duplicates=config.prevent_category_duplicates,
+        candidate_index=ctx.catalog_view.candidate_index,
+        day_indexes=ctx.prepared_schema.day_indexes,
+        rng=rng,
     )
 
-    enriched_days = []
-    for day_exercises in processed_obj.get("days", []):
-        enriched_day = []
-        for bName, eName in day_exercises:
-            exercise_details = request_name_to_exercise_map.get(eName, {})
-            enriched_day.append({
-                "eName": eName,
-                "bName": bName,
-                "kName": exercise_details.get("kName", eName),
-                "MG_num": exercise_details.get("MG_num", 0),
-                "musle_point_sum": exercise_details.get("musle_point_sum", 0),
-                "main_ex": exercise_details.get("main_ex", False),
-                "eInfoType": name_to_einfotype_map.get(eName),
-                "tool_en": exercise_details.get("tool_en", "Etc")
-            })
-        enriched_days.append(enriched_day)
+def enrich_day(day_exercises, catalog_view: CatalogView) -> list:
+    enriched_day = []
+    for bName, eName in day_exercises:
+        exercise_details = catalog_view.enrichment.get(eName)
+        if exercise_details is None:
+            exercise_details = {"kName": eName, "MG_num": 0, "musle_point_sum": 0, "main_ex": False, "eInfoType": None, "tool_en": "Etc"}
+        enriched_day.append({"eName": eName, "bName": bName, **exercise_details})
+    return enriched_day
+
+# --- Response Cache ---
+
+def _open_response_cache() -> Optional[ResponseCache]:
+    if os.getenv("RESPONSE_CACHE", "1") != "1":
+        return None
+    try:
+        return ResponseCache(RESPONSE_CACHE_PATH, max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_MB", "256")) * 1024 * 1024)
+    except Exception as e:
+        app.logger.warning(f"Response cache disabled: could not open {RESPONSE_CACHE_PATH}: {e}")
+        return None
+
+# Opened in the lifespan hook; None while the app is not running or when the cache is disabled
+RESPONSE_CACHE: Optional[ResponseCache] = None
+
+BEST_OF_REPAIR_WEIGHT = float(os.getenv("BEST_OF_REPAIR_WEIGHT", "1.0"))
+MUSCLE_CONTRIBUTIONS = build_muscle_contributions(name_to_exercise_map)
+
+def is_deterministic_request(config: UserConfig) -> bool:
+    return config.temperature == 0 or config.seed is not None
+
+async def schema_max_tokens(prepared_schema: PreparedSchema) -> Optional[int]:
+    """The schema-derived max_tokens budget, or None unless every count came from the model tokenizer."""
+    if not await TOKEN_COUNTER.fetch(prepared_schema.token_texts):
+        return None
+    return schema_token_budget(prepared_schema.schema, TOKEN_COUNTER, margin=TOKEN_BUDGET_MARGIN, slack=TOKEN_BUDGET_SLACK, whitespace=TOKEN_BUDGET_WHITESPACE)
+
+async def effective_max_tokens(config: UserConfig, prepared_schema: PreparedSchema) -> int:
+    """config.max_tokens, capped by the schema-derived budget when TOKEN_BUDGET_ENABLED is set."""
+    if TOKEN_BUDGET_ENABLED:
+        budget = await schema_max_tokens(prepared_schema)
+        if budget is not None:
+            return min(config.max_tokens, budget)
+    return config.max_tokens
+
+def record_token_usage(max_tokens: int, completion_tokens: Optional[int], finish_reasons: List[Optional[str]]):
+    """Logs the max_tokens sent against the tokens actually generated (over all choices), to check the budget holds."""
+    truncated = sum(1 for reason in finish_reasons if reason == "length")
+    if completion_tokens is not None and finish_reasons:
+        TOKEN_BUDGET_USAGE.observe(completion_tokens / len(finish_reasons) / max_tokens)
+    if truncated:
+        TOKEN_BUDGET_TRUNCATED_TOTAL.inc(truncated)
+        app.logger.warning(f"Token budget exceeded: max_tokens={max_tokens}, completion_tokens={completion_tokens}, truncated choices={truncated}/{len(finish_reasons)}")
+    else:
+        app.logger.info(f"Token budget: max_tokens={max_tokens}, completion_tokens={completion_tokens}, choices={len(finish_reasons)}")
+
+async def generate_candidates(config: UserConfig, ctx: InferenceContext, client_creator) -> List[Tuple[int, dict]]:
+    """Calls the backend for config.n candidates, or reuses the cached raw outputs of an identical
+    deterministic generation. Returns (choice index, parsed output) for every candidate that parsed."""
+    client, model_name, completer = client_creator()
+    max_tokens = await effective_max_tokens(config, ctx.prepared_schema)
+
+    cache_key = None
+    raws = None
+    if RESPONSE_CACHE is not None and is_deterministic_request(config):
+        sampling = {"temperature": config.temperature, "max_tokens": max_tokens, "seed": config.seed, "n": config.n}
+        cache_key = response_cache_key(model_name, ctx.prompt, ctx.prepared_schema.schema_hash, sampling)
+        cached = await asyncio.to_thread(RESPONSE_CACHE.get, cache_key)
+        if cached is not None:
+            raws = jsonio.loads(cached)
+
+    from_cache = raws is not None
+    if not from_cache:
+        with timed_stage("backend"):
+            resp = await call_backend(completer, prompt=ctx.prompt, week_schema=ctx.prepared_schema.schema_json, max_tokens=max_tokens, temperature=config.temperature, seed=config.seed, n=config.n)
+        choices = list(resp.choices or [])
+        record_token_usage(max_tokens, getattr(getattr(resp, "usage", None), "completion_tokens", None), [getattr(choice, "finish_reason", None) for choice in choices])
+        raws = [getattr(choice.message, "content", None) or "" for choice in resp.choices] or [""]
+
+    candidates = []
+    first_error = None
+    for index, raw in enumerate(raws):
+        try:
+            candidates.append((index, decode_week(parse_model_output(raw), ctx)))
+        except HTTPException as e:
+            first_error = first_error or e
+    if not candidates:
+        raise first_error
+
+    # Only generations with at least one parsable output are stored, so a malformed one is retried next time
+    if cache_key is not None and not from_cache:
+        await asyncio.to_thread(RESPONSE_CACHE.put, cache_key, jsonio.dumps(raws))
+    return candidates
+
+async def run_inference_request(config: UserConfig, client_creator) -> dict:
+    """Generates, repairs and post-validates one routine. Raises HTTPException on failure.
+
+    With config.n > 1 every candidate is post-validated and scored (see scoring.score_candidate);
+    the best one is returned along with all candidate scores.
+    """
+    rng = request_rng(config)
+    ctx = prepare_inference_context(config, rng)
+
+    candidates = await generate_candidates(config, ctx, client_creator)
+
+    with timed_stage("post_validate"):
+        results = []
+        for index, obj in candidates:
+            fixer = make_week_fixer(config, ctx, rng)
+            fixed_days = [fixer.fix_day(day_idx, day_exercises) for day_idx, day_exercises in enumerate(obj.get("days", []))]
+            if config.n > 1:
+                score = score_candidate(fixed_days, fixer.fixes, MUSCLE_CONTRIBUTIONS, repair_weight=BEST_OF_REPAIR_WEIGHT)
+            else:
+                score = None
+            results.append((index, obj, fixer, fixed_days, score))
+        # max() keeps the earliest candidate on ties
+        index, obj, fixer, fixed_days, _ = max(results, key=lambda result: result[4]["score"]) if config.n > 1 else results[0]
+        fixer.record_metrics()
+        enriched_days = [enrich_day(day, ctx.catalog_view) for day in fixed_days]
 
     final_response = {"days": enriched_days}
     
-    return JSONResponse(content={
+    response = {
         "routine": final_response,
         "raw_routine": obj,
-        "prompt": prompt
-    })
+        "prompt": ctx.prompt
+    }
+    if config.n > 1:
+        response["candidates"] = [{"index": i, "selected": i == index, **score} for i, _, _, _, score in results]
+    return response
+
+# --- Solver Backend ---
+
+async def run_solver_request(config: UserConfig) -> dict:
+    """Builds a routine without a model: solver.solve_week fills the week schema's slots to maximize
+    importance-weighted muscle coverage. The result goes through the same post-validation as model output."""
+    rng = request_rng(config)
+    ctx = prepare_inference_context(config, rng, solver=True)
+
+    with timed_stage("solve"):
+        obj = solve_week(
+            day_slots_from_schema(ctx.prepared_schema.schema),
+            ctx.catalog_view.exercise_map,
+            MUSCLE_CONTRIBUTIONS,
+            rng=rng,
+            prevent_weekly_duplicates=config.prevent_weekly_duplicates,
+            prevent_category_duplicates=config.prevent_category_duplicates,
+        )
+
+    with timed_stage("post_validate"):
+        fixer = make_week_fixer(config, ctx, rng)
+        fixed_days = [fixer.fix_day(day_idx, day_exercises) for day_idx, day_exercises in enumerate(obj["days"])]
+        score = score_candidate(fixed_days, fixer.fixes, MUSCLE_CONTRIBUTIONS, repair_weight=BEST_OF_REPAIR_WEIGHT)
+        fixer.record_metrics()
+        enriched_days = [enrich_day(day, ctx.catalog_view) for day in fixed_days]
 
-@app.post("/api/infer", summary="Generate workout routine using vLLM")
-async def infer_vllm_api(config: UserConfig):
-    def vllm_client_creator():
-        client = AsyncOpenAI(base_url=VLLM_BASE_URL, api_key="token-1234")
-        async def completer(prompt, week_schema, max_tokens, temperature):
-            return await client.chat.completions.create(
-                model=VLLM_MODEL, 
-                messages=[{"role": "user", "content": prompt}], 
-                temperature=temperature, # Use config.temperature
-                presence_penalty=0.2,
-                frequency_penalty=0.2,
-                max_tokens=max_tokens, 
-                extra_body={
-                    "guided_json": week_schema,
-                    "repetition_penalty": 1.2,
-                    "top_p": 0.9,
-                    # "top_k": 50
-                }
-            )
-        return client, VLLM_MODEL, completer
-    return await process_inference_request(config, vllm_client_creator)
+    return {
+        "routine": {"days": enriched_days},
+        "raw_routine": obj,
+        "prompt": None,
+        "solver": score,
+    }
+
+class DayStreamParser:
+    """Incrementally scans a streamed {"days":[[...],...]} document and returns each day array once it closes."""
+
+    DAY_DEPTH = 3  # '{' -> 1, "days" '[' -> 2, day '[' -> 3
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.day_start = None
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        completed_days = []
+        text = self.text
+        while self.pos < len(text):
+            ch = text[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in '[{':
+                self.depth += 1
+                if ch == '[' and self.depth == self.DAY_DEPTH:
+                    self.day_start = self.pos
+            elif ch in ']}':
+                if ch == ']' and self.depth == self.DAY_DEPTH and self.day_start is not None:
+                    completed_days.append(self._parse_day(text[self.day_start:self.pos + 1]))
+                    self.day_start = None
+                self.depth -= 1
+            self.pos += 1
+        return completed_days
+
+    @staticmethod
+    def _parse_day(day_text: str) -> list:
+        try:
+            return jsonio.loads(day_text)
+        except jsonio.JSONDecodeError:
+            repaired = json.loads(json_repair_str(day_text) or "[]")
+            return repaired if isinstance(repaired, list) else []
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {jsonio.dumps(data)}\n\n"
+
+# --- Admission Control ---
+
+# Lanes in priority order: interactive requests are always admitted before queued batch/test work
+ADMISSION = AdmissionController(
+    max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "64")),
+    lanes=[
+        Lane("interactive", max_queue=int(os.getenv("ADMISSION_INTERACTIVE_QUEUE", "256")), max_wait=float(os.getenv("ADMISSION_INTERACTIVE_WAIT", "10"))),
+        Lane("batch", max_queue=int(os.getenv("ADMISSION_BATCH_QUEUE", "2000")), max_wait=float(os.getenv("ADMISSION_BATCH_WAIT", "600"))),
+    ],
+)
+
+def lane_for(priority: Optional[str]) -> str:
+    return "batch" if priority and priority.lower() == "batch" else "interactive"
+
+def _shed(e: AdmissionRejected) -> HTTPException:
+    ADMISSION_REJECTED_TOTAL.inc(lane=e.lane, reason=e.reason)
+    app.logger.warning(f"[Admission] Shedding request: {e} (Retry-After {e.retry_after}s)")
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=f"Server is at capacity ({e}). Retry later.",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+async def run_admitted(lane: str, run):
+    """Awaits run() once the admission controller grants a slot; sheds the request with 429 otherwise."""
+    try:
+        async with ADMISSION.admit(lane) as waited:
+            record_stage("queue", waited)
+            return await run()
+    except AdmissionRejected as e:
+        raise _shed(e)
+
+async def acquire_admission(lane: str) -> Callable[[], None]:
+    """Takes a slot for work that outlives the handler, such as a streamed response. Returns a release
+    function that is safe to call more than once; sheds the request with 429 like run_admitted."""
+    try:
+        waited = await ADMISSION.acquire(lane)
+    except AdmissionRejected as e:
+        raise _shed(e)
+    record_stage("queue", waited)
+    started = time.perf_counter()
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            ADMISSION.release(time.perf_counter() - started)
+    return release
+
+# --- Request Coalescing & Idempotency ---
+
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+IN_FLIGHT_REQUESTS = SingleFlight()
+IDEMPOTENCY_STORE = IdempotencyStore(
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", "600")),
+    max_entries=int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000")),
+)
+
+def request_fingerprint(backend_name: str, config: UserConfig) -> str:
+    payload = json.dumps({"backend": backend_name, "config": config.model_dump()}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+async def process_inference_request(config: UserConfig, client_creator, backend_name: str = "vllm", idempotency_key: Optional[str] = None, runner=None, lane: Optional[str] = "interactive"):
+    """Runs one inference. Concurrent identical requests share a single backend call, and a repeated
+    Idempotency-Key within IDEMPOTENCY_TTL returns the stored result without calling the backend.
+
+    `runner` replaces the default run_inference_request(config, client_creator) call. Only the call
+    that actually runs takes an admission slot in `lane`; coalesced followers and replays do not.
+    lane=None skips admission control (for the CPU-only solver backend).
+    """
+    unadmitted_run = runner or (lambda: run_inference_request(config, client_creator))
+    run = (lambda: run_admitted(lane, unadmitted_run)) if lane else unadmitted_run
+    fingerprint = request_fingerprint(backend_name, config)
+    store_key = f"{backend_name}:{idempotency_key}" if idempotency_key else None
+
+    if store_key:
+        stored = IDEMPOTENCY_STORE.get(store_key)
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request body.")
+            IDEMPOTENCY_STORE.replays += 1
+            return FastJSONResponse(content=stored.result, headers={"Idempotent-Replayed": "true"})
+
+    if COALESCE_REQUESTS or store_key:
+        # A retried Idempotency-Key joins the original call even when general coalescing is off
+        flight_key = fingerprint if COALESCE_REQUESTS else f"{fingerprint}:{store_key}"
+        result = await IN_FLIGHT_REQUESTS.do(flight_key, run)
+    else:
+        result = await run()
+
+    if store_key:
+        IDEMPOTENCY_STORE.put(store_key, fingerprint, result)
+    return FastJSONResponse(content=result)
+
+def vllm_client_creator():
+    backend = get_backend("vllm")
+    async def completer(prompt, week_schema, max_tokens, temperature, seed=None, n=1, stream=False):
+        return await backend.create_chat_completion(
+            model=VLLM_MODEL, 
+            messages=[{"role": "user", "content": prompt}], 
+            temperature=temperature, # Use config.temperature
+            seed=seed,
+            n=n,
+            presence_penalty=0.2,
+            frequency_penalty=0.2,
+            max_tokens=max_tokens, 
+            stream=stream,
+            # The final chunk of a stream then carries the usage, for record_token_usage
+            stream_options={"include_usage": True} if stream else openai.NOT_GIVEN,
+            extra_body={
+                "guided_json": week_schema,
+                "repetition_penalty": 1.2,
+                "top_p": 0.9,
+                # "top_k": 50
+            }
+        )
+    return backend.client, VLLM_MODEL, completer
+
+def openai_client_creator():
+    backend = get_backend("openai")
+    async def completer(prompt, week_schema, max_tokens, temperature, seed=None, n=1):
+        return await backend.create_chat_completion(
+            model=OPENAI_MODEL, 
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            temperature=temperature, # Use config.temperature
+            seed=seed,
+            n=n,
+            response_format={"type": "json_object"}
+        )
+    return backend.client, OPENAI_MODEL, completer
+
+# Answer requests shed by admission control with the solver instead of a 429
+SOLVER_FALLBACK = os.getenv("SOLVER_FALLBACK", "0") == "1"
+
+@app.post("/api/infer", summary="Generate workout routine using vLLM or the local solver")
+async def infer_vllm_api(config: UserConfig, backend: Literal["vllm", "solver"] = Query("vllm", description="'solver' builds the routine without a model"), idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), priority: Optional[str] = Header(None, alias="X-Priority")):
+    if backend == "solver":
+        return await process_inference_request(config, None, backend_name="solver", idempotency_key=idempotency_key, runner=lambda: run_solver_request(config), lane=None)
+    try:
+        return await process_inference_request(config, vllm_client_creator, backend_name="vllm", idempotency_key=idempotency_key, lane=lane_for(priority))
+    except HTTPException as e:
+        if e.status_code != status.HTTP_429_TOO_MANY_REQUESTS or not SOLVER_FALLBACK:
+            raise
+        SOLVER_FALLBACK_TOTAL.inc()
+        app.logger.warning("[Admission] Answering shed request with the solver backend")
+        response = await process_inference_request(config, None, backend_name="solver", idempotency_key=idempotency_key, runner=lambda: run_solver_request(config), lane=None)
+        response.headers["X-Routine-Backend"] = "solver"
+        return response
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+class ClosingStreamingResponse(StreamingResponse):
+    """A StreamingResponse that awaits `on_close` however it ends. Starlette skips `background` when the
+    client disconnects, and a body iterator that never started never runs its own finally block."""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+async def solver_event_stream(config: UserConfig):
+    """The solver's routine as the same `day`/`done` events the model stream emits."""
+    result = await run_solver_request(config)
+    for day_idx, enriched_day in enumerate(result["routine"]["days"]):
+        yield _sse_event("day", {"index": day_idx, "exercises": enriched_day})
+    yield _sse_event("done", result)
+
+@app.post("/api/infer/stream", summary="Stream a workout routine day by day as Server-Sent Events using vLLM")
+async def infer_vllm_stream_api(config: UserConfig, priority: Optional[str] = Header(None, alias="X-Priority")):
+    """Emits a `day` event as soon as each day is generated and post-validated, then a final `done` event
+    with the same body as /api/infer. Failures after the stream has started are sent as an `error` event.
+
+    The admission slot is held until the stream ends or the client disconnects. A shed request gets a
+    429, or the solver's routine when SOLVER_FALLBACK is set. Best-of-N (n > 1) is not supported here.
+    """
+    if config.n > 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="n > 1 is not supported when streaming; use /api/infer for best-of-N.")
+
+    try:
+        release = await acquire_admission(lane_for(priority))
+    except HTTPException as e:
+        if e.status_code != status.HTTP_429_TOO_MANY_REQUESTS or not SOLVER_FALLBACK:
+            raise
+        SOLVER_FALLBACK_TOTAL.inc()
+        app.logger.warning("[Admission] Answering shed stream request with the solver backend")
+        return StreamingResponse(solver_event_stream(config), media_type="text/event-stream", headers={**SSE_HEADERS, "X-Routine-Backend": "solver"})
+
+    try:
+        rng = request_rng(config)
+        ctx = prepare_inference_context(config, rng)
+        client, model_name, completer = vllm_client_creator()
+        max_tokens = await effective_max_tokens(config, ctx.prepared_schema)
+        stream = await call_backend(completer, prompt=ctx.prompt, week_schema=ctx.prepared_schema.schema_json, max_tokens=max_tokens, temperature=config.temperature, seed=config.seed, stream=True)
+    except BaseException:
+        release()
+        raise
+
+    async def close_stream():
+        # Runs from event_stream() and again from the response; both steps are idempotent
+        try:
+            await stream.close()
+        finally:
+            release()
+
+    async def event_stream():
+        parser = DayStreamParser()
+        fixer = make_week_fixer(config, ctx, rng)
+        raw_parts = []
+        enriched_days = []
+
+        def emit_day(day_exercises) -> str:
+            day_idx = len(enriched_days)
+            enriched_day = enrich_day(fixer.fix_day(day_idx, decode_exercise_ids(day_exercises, ctx.exercise_names_by_id, ctx.catalog_view.exercise_map)), ctx.catalog_view)
+            enriched_days.append(enriched_day)
+            return _sse_event("day", {"index": day_idx, "exercises": enriched_day})
+
+        try:
+            completion_tokens = None
+            finish_reason = None
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    completion_tokens = usage.completion_tokens
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                raw_parts.append(delta)
+                for day_exercises in parser.feed(delta):
+                    yield emit_day(day_exercises)
+            record_token_usage(max_tokens, completion_tokens, [finish_reason])
+
+            obj = decode_week(parse_model_output("".join(raw_parts)), ctx)
+            # Days the incremental parser could not close (e.g. truncated output) come from the repaired JSON
+            for day_exercises in obj["days"][len(enriched_days):]:
+                yield emit_day(day_exercises)
+
+            yield _sse_event("done", {
+                "routine": {"days": enriched_days},
+                "raw_routine": obj,
+                "prompt": ctx.prompt
+            })
+        except HTTPException as e:
+            yield _sse_event("error", {"detail": e.detail, "status_code": e.status_code})
+        except Exception as e:
+            app.logger.error(f"Error while streaming AI model output: {e}", exc_info=True)
+            yield _sse_event("error", {"detail": f"AI model inference failed: {e}", "status_code": status.HTTP_500_INTERNAL_SERVER_ERROR})
+        finally:
+            # Days already sent were returned to the client, so their repairs count even if the stream failed
+            fixer.record_metrics()
+            await close_stream()
+
+    return ClosingStreamingResponse(event_stream(), close_stream, media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/api/infer/batch", summary="Generate workout routines for many configurations using vLLM or the local solver")
+async def infer_vllm_batch_api(batch: BatchInferRequest, backend: Literal["vllm", "solver"] = Query("vllm", description="'solver' builds the routines without a model")):
+    if len(batch.configs) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Batch too large: {len(batch.configs)} configs (max {BATCH_MAX_ITEMS}).")
+
+    # Prompt fragments and week schemas are shared through their caches, so configs that
+    # differ only in weight/intensity/etc. reuse the same work; generation itself is per item.
+    concurrency = min(batch.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_item(index: int, config: UserConfig) -> dict:
+        async with semaphore:
+            try:
+                if backend == "solver":
+                    return {"index": index, **await run_solver_request(config)}
+                return {"index": index, **await run_admitted("batch", lambda: run_inference_request(config, vllm_client_creator))}
+            except HTTPException as e:
+                return {"index": index, "error": e.detail, "status_code": e.status_code}
+            except Exception as e:
+                app.logger.error(f"Error in batch item {index}: {e}", exc_info=True)
+                return {"index": index, "error": f"An unexpected error occurred: {str(e)}", "status_code": status.HTTP_500_INTERNAL_SERVER_ERROR}
+
+    results = await asyncio.gather(*(run_item(i, config) for i, config in enumerate(batch.configs)))
+    failed = sum(1 for result in results if "error" in result)
+    return FastJSONResponse(content={
+        "results": results,
+        "succeeded": len(results) - failed,
+        "failed": failed,
+    })
 
 @app.post("/api/generate-openai", summary="Generate workout routine using OpenAI API")
-async def infer_openai_api(config: UserConfig):
+async def infer_openai_api(config: UserConfig, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), priority: Optional[str] = Header(None, alias="X-Priority")):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="OPENAI_API_KEY not set in environment variables.")
-    
-    def openai_client_creator():
-        client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-        async def completer(prompt, week_schema, max_tokens, temperature):
-            return await client.chat.completions.create(
-                model=OPENAI_MODEL, 
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=temperature, # Use config.temperature
-                response_format={"type": "json_object"}
-            )
-        return client, OPENAI_MODEL, completer
-    return await process_inference_request(config, openai_client_creator)
+    return await process_inference_request(config, openai_client_creator, backend_name="openai", idempotency_key=idempotency_key, lane=lane_for(priority))
+
+# --- Hedged Routing ---
+
+HEDGE_PRIMARY = os.getenv("HEDGE_PRIMARY", "vllm")
+HEDGE_SECONDARY = os.getenv("HEDGE_SECONDARY", "openai")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "30"))  # Used until the primary has HEDGE_MIN_SAMPLES latencies
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1"))
+LATENCY_BUDGET = float(os.getenv("LATENCY_BUDGET", "120"))
+
+CLIENT_CREATORS = {"vllm": vllm_client_creator, "openai": openai_client_creator}
+
+def hedge_delay(primary: str, budget: float) -> float:
+    """Seconds to wait for the primary before hedging: its observed HEDGE_PERCENTILE latency."""
+    backend = BACKENDS.get(primary)
+    observed = backend.latency_percentile(HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES) if backend else None
+    delay = observed if observed is not None else HEDGE_DEFAULT_DELAY
+    return min(max(delay, HEDGE_MIN_DELAY), budget)
+
+async def run_hedged_inference(config: UserConfig, budget: float) -> dict:
+    """Runs the request on HEDGE_PRIMARY and, if it has not answered within hedge_delay() or has
+    failed, also on HEDGE_SECONDARY. The first valid result wins and the other call is cancelled.
+    Raises 504 when nothing valid arrives within `budget` seconds."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget
+    delay = hedge_delay(HEDGE_PRIMARY, budget)
+    hedge_at = loop.time() + delay
+    can_hedge = HEDGE_SECONDARY != HEDGE_PRIMARY and HEDGE_SECONDARY in BACKENDS and HEDGE_SECONDARY in CLIENT_CREATORS
+    hedged = False
+
+    backend_of: Dict[asyncio.Task, str] = {}
+    pending = set()
+    last_error = None
+
+    def launch(name: str):
+        task = asyncio.ensure_future(run_inference_request(config, CLIENT_CREATORS[name]))
+        backend_of[task] = name
+        pending.add(task)
+
+    launch(HEDGE_PRIMARY)
+    try:
+        while pending or (can_hedge and not hedged):
+            now = loop.time()
+            if now >= deadline:
+                HEDGE_TOTAL.inc(outcome="budget_exceeded")
+                raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=f"No valid routine within the {budget:g}s latency budget.")
+            if not pending:
+                # The primary already failed; hedge right away instead of waiting
+                launch(HEDGE_SECONDARY)
+                hedged = True
+                continue
+
+            timeout = deadline - now
+            if can_hedge and not hedged:
+                timeout = min(timeout, max(hedge_at - now, 0))
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                try:
+                    result = task.result()
+                except HTTPException as e:
+                    app.logger.warning(f"[Hedge] {backend_of[task]} failed: {e.detail}")
+                    last_error = e
+                    continue
+                except Exception as e:
+                    app.logger.error(f"[Hedge] {backend_of[task]} failed: {e}", exc_info=True)
+                    last_error = HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred: {str(e)}")
+                    continue
+                winner = backend_of[task]
+                HEDGE_TOTAL.inc(outcome=f"hedged_{'primary' if winner == HEDGE_PRIMARY else 'secondary'}_won" if hedged else "primary_only")
+                return {**result, "backend": winner, "hedged": hedged}
+
+            if can_hedge and not hedged and loop.time() >= hedge_at and pending:
+                app.logger.info(f"[Hedge] {HEDGE_PRIMARY} has not answered after {delay:.1f}s; hedging to {HEDGE_SECONDARY}")
+                launch(HEDGE_SECONDARY)
+                hedged = True
+
+        HEDGE_TOTAL.inc(outcome="failed")
+        raise last_error
+    finally:
+        for task in backend_of:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # Mark a losing failure as retrieved
+
+@app.post("/api/infer/hedged", summary="Generate a workout routine within a latency budget, hedging from vLLM to OpenAI")
+async def infer_hedged_api(config: UserConfig, budget: Optional[float] = Query(None, gt=0, description="Latency budget in seconds (default LATENCY_BUDGET)"), idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"), priority: Optional[str] = Header(None, alias="X-Priority")):
+    budget = budget or LATENCY_BUDGET
+    return await process_inference_request(config, None, backend_name="hedged", idempotency_key=idempotency_key, runner=lambda: run_hedged_inference(config, budget), lane=lane_for(priority))
+
+@app.get("/api/admission-stats", summary="Get admission control slot usage, queue depths and shed counts")
+async def get_admission_stats_api():
+    return FastJSONResponse(content=ADMISSION.stats())
+
+@app.get("/api/backend-stats", summary="Get connection pool statistics for the model backends")
+async def get_backend_stats_api():
+    return FastJSONResponse(content={name: backend.stats() for name, backend in BACKENDS.items()})
 
 app.mount("/data", StaticFiles(directory=DATA_DIR, html=True), name="data")
 app.mount("/", StaticFiles(directory="web", html=True), name="static")
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import bisect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+# Minimal Prometheus text-format metrics (no prometheus_client dependency)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [per-bucket counts (non-cumulative, last slot is +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("routine_stage_duration_seconds", "Time spent in each stage of routine generation.", ("stage",))
+TOKENS_TOTAL = REGISTRY.counter("routine_tokens_total", "Tokens reported by the model backend.", ("backend", "kind"))
+FIXES_TOTAL = REGISTRY.counter("routine_post_validation_fixes_total", "Exercises replaced or dropped during post-validation.", ("kind",))
+OUTPUT_PARSE_TOTAL = REGISTRY.counter("routine_output_parse_total", "Model outputs parsed, by path (strict, repaired, failed).", ("path",))
+HEDGE_TOTAL = REGISTRY.counter("routine_hedge_total", "Outcomes of hedged inference requests.", ("outcome",))
+ADMISSION_REJECTED_TOTAL = REGISTRY.counter("routine_admission_rejected_total", "Requests shed by admission control.", ("lane", "reason"))
+TOKEN_BUDGET_USAGE = REGISTRY.histogram(
+    "routine_token_budget_usage_ratio", "Completion tokens per choice divided by the schema-derived max_tokens.",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0),
+)
+TOKEN_BUDGET_TRUNCATED_TOTAL = REGISTRY.counter("routine_token_budget_truncated_total", "Choices cut off by the schema-derived max_tokens.")
+SOLVER_FALLBACK_TOTAL = REGISTRY.counter("routine_solver_fallback_total", "Shed requests answered by the solver backend instead of a 429.")
+BACKEND_ERRORS_TOTAL = REGISTRY.counter("routine_backend_errors_total", "Failed model backend calls.", ("backend", "error"))
+
+# Stage timings of the current request, collected for the Server-Timing header
+_request_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_timings", default=None)
+
+
+def start_request_timings() -> List[Tuple[str, float]]:
+    """Starts collecting stage timings for the current request; returns the list they are appended to."""
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+
+def record_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timed_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def server_timing_header(timings: List[Tuple[str, float]]) -> str:
+    """Renders the collected stage timings as a Server-Timing header value.
+
+    Only stages that ran for this request appear: "allowed_names" and "schema" only on a week-schema
+    cache miss, "backend" not on a response-cache hit or with the solver backend, "queue" only for requests
+    that went through admission control.
+    A request coalesced onto an identical in-flight one, or replayed by Idempotency-Key, did none of
+    the work and reports no stages.
+    """
+    # Repeated stages (e.g. "parse" for each of n candidates, or "backend" for both legs of a
+    # hedged request) are summed into one entry
+    totals: Dict[str, float] = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in totals.items())
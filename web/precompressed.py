@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # Optional; gzip is always available
+    brotli = None
+
+# Preferred first when the client accepts several encodings
+ENCODING_PREFERENCE = ("br", "gzip")
+
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    return accepted
+
+
+def _etag_values(if_none_match: str):
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            yield tag
+
+
+class PrecompressedPayload:
+    """A response body serialized and compressed once, served with strong ETags and 304 revalidation."""
+
+    def __init__(self, body: bytes, media_type: str = "application/json", version: Optional[str] = None):
+        self.version = version or hashlib.sha256(body).hexdigest()[:16]
+        self.media_type = media_type
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=11)
+
+    def etag(self, encoding: str) -> str:
+        # Each encoding is a distinct representation, so each gets its own strong ETag
+        return f'"{self.version}"' if encoding == "identity" else f'"{self.version}-{encoding}"'
+
+    def negotiate(self, accept_encoding: str) -> str:
+        accepted = _accepted_encodings(accept_encoding)
+        wildcard = accepted.get("*", 0.0)
+        for encoding in ENCODING_PREFERENCE:
+            if encoding in self.bodies and accepted.get(encoding, wildcard) > 0:
+                return encoding
+        return "identity"
+
+    def response(self, request: Request, headers: Optional[Dict[str, str]] = None) -> Response:
+        encoding = self.negotiate(request.headers.get("accept-encoding", ""))
+        response_headers = {
+            "ETag": self.etag(encoding),
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache",
+            **(headers or {}),
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            known = {self.etag(e) for e in self.bodies}
+            if any(tag == "*" or tag in known for tag in _etag_values(if_none_match)):
+                return Response(status_code=304, headers=response_headers)
+
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        return Response(content=self.bodies[encoding], media_type=self.media_type, headers=response_headers)
+
+    def stats(self) -> dict:
+        return {"version": self.version, "bytes": {encoding: len(body) for encoding, body in self.bodies.items()}}
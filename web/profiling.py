@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import List
+
+from pyinstrument import Profiler
+from pyinstrument.renderers import SpeedscopeRenderer
+
+
+class ProfileCapture:
+    """Artifacts written for one profiled request, filled in when the profile block exits."""
+
+    def __init__(self):
+        self.artifacts: List[str] = []
+
+
+@contextmanager
+def profile_to_dir(output_dir: str, label: str, interval: float = 0.001):
+    """Sampling-profiles the enclosed block and writes the results to output_dir: a speedscope
+    flamegraph (open at https://www.speedscope.app) plus an HTML call tree.
+
+    async_mode="enabled" attributes time to the awaiting coroutine only, so other requests running
+    on the event loop meanwhile do not show up in the profile.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    safe_label = re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_") or "request"
+    base = os.path.join(output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 1_000_000_000:09d}-{safe_label}")
+    capture = ProfileCapture()
+
+    profiler = Profiler(interval=interval, async_mode="enabled")
+    profiler.start()
+    try:
+        yield capture
+    finally:
+        profiler.stop()
+        speedscope_path = f"{base}.speedscope.json"
+        with open(speedscope_path, "w", encoding="utf-8") as f:
+            f.write(profiler.output(renderer=SpeedscopeRenderer()))
+        html_path = f"{base}.html"
+        with open(html_path, "w", encoding="utf-8") as f:
+            f.write(profiler.output_html())
+        capture.artifacts.extend([speedscope_path, html_path])
@@ -1,49 +1,98 @@
-common_prompt = '''## [Task]
-Return a weekly bodybuilding plan as MINIFIED JSON only.
+# Prompt sections, shared by both layouts below so their rules cannot drift apart
+TASK_SECTION = '''## [Task]
+Return a weekly bodybuilding plan as MINIFIED JSON only.'''
 
-## [User Info]
+USER_INFO_SECTION = '''## [User Info]
 - Gender: {gender}
 - Weight: {weight}kg
 - Training Level: {level}
 - Weekly Workout Frequency: {freq}
 - Workout Duration: {duration} minutes
-- Workout Intensity: {intensity}
+- Workout Intensity: {intensity}'''
 
-## Split
-- Name: {split_name}; Days: {split_days}.
+SPLIT_SECTION = '''## Split
+- Name: {split_name}; Days: {split_days}.'''
 
-## Equipment priority rule:
-{level_guide}
+EQUIPMENT_SECTION = '''## Equipment priority rule:
+{level_guide}'''
 
-## CATEGORY RULE (HARD CONSTRAINT):
+CATEGORY_RULE_SECTION = '''## CATEGORY RULE (HARD CONSTRAINT):
 - For each day, you MUST output **NO MORE THAN ONE exercise per category (Benchpress, LUNGE, Push Ups, Deadlift...)**
 - If a violation occurs, the output is INVALID. Re-check and regenerate until the rule is satisfied.
-- Exception: The '(Uncategorized)' group may allow multiple exercises.
+- Exception: The '(Uncategorized)' group may allow multiple exercises.'''
 
-## Content rules
+CONTENT_RULES_SECTION = '''## Content rules
 - NO DUPLICATE EXERCISES IN THE WEEK.
-- IGNORE CATALOG ORDERING: Treat all catalog items as equally valid; never always default to the first option.
+- IGNORE CATALOG ORDERING: Treat all catalog items as equally valid; never always default to the first option.'''
 
-## Importance Weights
+IMPORTANCE_WEIGHTS_SECTION = '''## Importance Weights
 - Chest: Upper 3, Middle 3, Lower 2  
 - Back: Upper 3, Lower 3, Lats 3  
 - Shoulders: Anterior 2, Lateral 2, Posterior 2, Traps 1  
 - Abs: Upper Abs 2, Lower Abs 2, Obliques 1, Core 1
 - Arm: Biceps 2, Triceps 2, Forearms 1  
 - Legs: Glutes 3, Quads 3, Hamstrings 3, Adductors 2, Abductors 2, Calves 1
-- Prioritize exercises that target higher-importance muscle groups. Aim to achieve a higher total activation score for muscle groups with a weight of 3, and a moderate score for groups with a weight of 2. Ensure lower-importance groups are not excluded so that the overall routine remains well-balanced.
+- Prioritize exercises that target higher-importance muscle groups. Aim to achieve a higher total activation score for muscle groups with a weight of 3, and a moderate score for groups with a weight of 2. Ensure lower-importance groups are not excluded so that the overall routine remains well-balanced.'''
 
-{split_rules}
+SPLIT_RULES_SECTION = "{split_rules}"
 
-## Catalog
-# The catalog is grouped by Day, then by Tool Type, then by Category.
-# Each item = [bName, eName, MG_num, {{"micro":["part(score)", ...]}}]
-{catalog_json}
+CATALOG_SECTION = '''## Catalog
+{catalog_format}
+{catalog_json}'''
 
-## Output
+OUTPUT_SECTION = '''## Output
 Return exactly one MINIFIED JSON object only (NO WHITESPACES / NO NEW LINES), matching:
-{{"days":[[[bodypart,ename],...],...]}}
-'''
+{output_format}'''
+
+
+def _join_sections(*sections: str) -> str:
+    return "\n\n".join(sections) + "\n"
+
+
+common_prompt = _join_sections(
+    TASK_SECTION,
+    USER_INFO_SECTION,
+    SPLIT_SECTION,
+    EQUIPMENT_SECTION,
+    CATEGORY_RULE_SECTION,
+    CONTENT_RULES_SECTION,
+    IMPORTANCE_WEIGHTS_SECTION,
+    SPLIT_RULES_SECTION,
+    CATALOG_SECTION,
+    OUTPUT_SECTION,
+)
+
+# Same sections as common_prompt, ordered for vLLM automatic prefix caching: static rules first, then
+# the per-split rules and catalog (rendered in a fixed order), and the user-specific fields last.
+prefix_cache_prompt = _join_sections(
+    TASK_SECTION,
+    CATEGORY_RULE_SECTION,
+    CONTENT_RULES_SECTION,
+    IMPORTANCE_WEIGHTS_SECTION,
+    SPLIT_SECTION,
+    SPLIT_RULES_SECTION,
+    CATALOG_SECTION,
+    EQUIPMENT_SECTION,
+    USER_INFO_SECTION,
+    OUTPUT_SECTION,
+)
+
+
+# Catalog section header per catalog encoding and output shape per encoding/output format (see util.build_prompt)
+CATALOG_FORMATS = {
+    "json": '''# The catalog is grouped by Day, then by Tool Type, then by Category.
+# Each item = [bName, eName, MG_num, {"micro":["part(score)", ...]}]''',
+    "compact": '''# The catalog is grouped by Day, then by body part, then by Category ("Category: item; item; ...").
+# Each item = ID|eName|tool|muscle codes with scores; "*" after the ID marks a main exercise.
+# Tools: {tool_legend}
+# Muscles: {muscle_legend}''',
+}
+
+OUTPUT_FORMATS = {
+    "json": '{"days":[[[bodypart,ename],...],...]}',
+    "compact": '{"days":[[[bodypart,ID],...],...]} where ID is the integer catalog ID',
+    "compact_ids": '{"days":[[ID,...],...]} where ID is the integer catalog ID',
+}
 
 SPLIT_RULES = {
     2: """### 2 DAYS — UPPER / LOWER
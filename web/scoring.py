@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import re
+from typing import Dict, Iterable, List, Tuple
+
+# Importance weights from the prompt (prompts.py, "## Importance Weights"), keyed by the
+# tokens a muscle part name must contain. Longer keys are matched first.
+MUSCLE_IMPORTANCE: Dict[Tuple[str, ...], int] = {
+    ("upper", "chest"): 3, ("middle", "chest"): 3, ("lower", "chest"): 2,
+    ("upper", "back"): 3, ("lower", "back"): 3, ("lats",): 3,
+    ("anterior",): 2, ("lateral",): 2, ("posterior",): 2, ("traps",): 1,
+    ("upper", "abs"): 2, ("lower", "abs"): 2, ("obliques",): 1, ("core",): 1,
+    ("biceps",): 2, ("triceps",): 2, ("forearms",): 1,
+    ("glutes",): 3, ("quads",): 3, ("hamstrings",): 3, ("adductors",): 2, ("abductors",): 2, ("calves",): 1,
+}
+TOKEN_ALIASES = {
+    "lat": "lats", "latissimus": "lats", "trap": "traps", "trapezius": "traps",
+    "quad": "quads", "quadriceps": "quads", "glute": "glutes", "gluteus": "glutes",
+    "hamstring": "hamstrings", "calf": "calves", "oblique": "obliques", "forearm": "forearms",
+    "adductor": "adductors", "abductor": "abductors", "mid": "middle", "front": "anterior",
+    "side": "lateral", "rear": "posterior", "ab": "abs",
+}
+# musle_point scores run 1-5; a muscle counts as fully covered once the week reaches this total
+COVERAGE_TARGET = 5
+_MATCH_ORDER = sorted(MUSCLE_IMPORTANCE, key=len, reverse=True)
+_TOTAL_WEIGHT = sum(MUSCLE_IMPORTANCE.values())
+
+
+def _muscle_key(part: str):
+    tokens = {TOKEN_ALIASES.get(token, token) for token in re.findall(r"[a-z]+", part.lower())}
+    return next((key for key in _MATCH_ORDER if tokens.issuperset(key)), None)
+
+
+def muscle_contributions(exercise: dict) -> Tuple[Tuple[Tuple[str, ...], int], ...]:
+    """Pairs each weighted muscle an exercise targets (from MG) with its musle_point score."""
+    mg = exercise.get('MG')
+    scores = exercise.get('musle_point') or []
+    parts = [p.strip() for p in mg.split('/')] if isinstance(mg, str) and mg.strip() else []
+    if len(parts) != len(scores):
+        return ()
+    contributions = []
+    for part, score in zip(parts, scores):
+        key = _muscle_key(part)
+        if key is not None and isinstance(score, (int, float)):
+            contributions.append((key, score))
+    return tuple(contributions)
+
+
+def build_muscle_contributions(exercise_map: dict) -> Dict[str, tuple]:
+    return {name: muscle_contributions(exercise) for name, exercise in exercise_map.items()}
+
+
+def weighted_coverage(exercise_names: Iterable[str], contributions: Dict[str, tuple]) -> float:
+    """Importance-weighted share of muscle groups the week covers, from 0.0 to 1.0."""
+    activation: Dict[Tuple[str, ...], float] = {}
+    for name in exercise_names:
+        for key, score in contributions.get(name, ()):
+            activation[key] = activation.get(key, 0) + score
+    covered = sum(MUSCLE_IMPORTANCE[key] * min(total, COVERAGE_TARGET) / COVERAGE_TARGET for key, total in activation.items())
+    return covered / _TOTAL_WEIGHT
+
+
+def score_candidate(fixed_days: List[list], fixes: Dict[str, int], contributions: Dict[str, tuple], repair_weight: float = 1.0) -> dict:
+    """Scores a post-validated week: muscle coverage minus the share of exercises that had to be repaired."""
+    names = [name for day in fixed_days for _, name in day]
+    repair_cost = sum(fixes.values())
+    coverage = weighted_coverage(names, contributions)
+    repair_rate = repair_cost / max(len(names), 1)
+    return {
+        "repairs": dict(fixes),
+        "repair_cost": repair_cost,
+        "coverage": round(coverage, 4),
+        "score": round(coverage - repair_weight * repair_rate, 4),
+    }
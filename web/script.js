@@ -42,8 +42,27 @@ document.addEventListener('DOMContentLoaded', async () => {
     let currentRoutineData = null;
     let currentRawRoutineData = null;
     let currentOutputElement = null;
+    let similarExercisesCache = {};
 
     // --- 함수 정의 ---
+    const prefetchSimilarExercises = async (routine) => {
+        // 루틴의 모든 운동에 대한 유사 운동을 한 번의 요청으로 미리 가져오기
+        const names = [...new Set(routine.days.flat().map(ex => ex.eName))];
+        if (names.length === 0) return;
+        try {
+            const response = await fetch('/api/similar-exercises', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ names }),
+            });
+            if (response.ok) {
+                Object.assign(similarExercisesCache, await response.json());
+            }
+        } catch (error) {
+            console.error('Error prefetching similar exercises:', error);
+        }
+    };
+
     const updateSplitOptions = (frequency) => {
         // 주당 운동 빈도에 따라 분할/무분할 옵션 업데이트
         splitTypeSelect.innerHTML = '';
@@ -121,6 +140,7 @@ document.addEventListener('DOMContentLoaded', async () => {
             currentRoutineData = result.routine;
             currentRawRoutineData = result.raw_routine;
             renderRoutine(); // 초기 렌더링
+            prefetchSimilarExercises(currentRoutineData);
 
         } catch (error) {
             console.error(`Error generating routine via ${apiEndpoint}:`, error);
@@ -420,10 +440,13 @@ document.addEventListener('DOMContentLoaded', async () => {
         modal.style.display = 'flex';
 
         try {
-            const response = await fetch(`/api/similar-exercises/${ename}`);
-            if (!response.ok) throw new Error('Failed to fetch similar exercises.');
-            
-            const similarExercises = await response.json();
+            let similarExercises = similarExercisesCache[ename];
+            if (!similarExercises) {
+                const response = await fetch(`/api/similar-exercises/${ename}`);
+                if (!response.ok) throw new Error('Failed to fetch similar exercises.');
+                similarExercises = await response.json();
+                similarExercisesCache[ename] = similarExercises;
+            }
 
             if (similarExercises.length === 0) {
                 modalList.innerHTML = 'No similar exercises found.';
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import random
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from .scoring import COVERAGE_TARGET, MUSCLE_IMPORTANCE
+
+# How much a day's own balance counts next to the week's coverage when ranking candidates
+DAY_COVERAGE_WEIGHT = 0.5
+UNCATEGORIZED = '(Uncategorized)'
+
+Pair = Tuple[str, str]
+
+
+def _resolve(node, root):
+    while isinstance(node, dict) and "$ref" in node:
+        target = root
+        for part in node["$ref"].lstrip('#').strip('/').split('/'):
+            target = target[part]
+        node = target
+    return node
+
+
+def day_slots_from_schema(schema: dict) -> List[List[List[Pair]]]:
+    """Reads a name-based week schema into per-day slots, each a list of allowed (bName, eName) pairs.
+
+    Required main-exercise slots (prefixItems) come first, as in the schema; $refs are resolved.
+    """
+    days = []
+    week = _resolve(schema["properties"]["days"], schema)
+    for day_schema in week["prefixItems"]:
+        day_schema = _resolve(day_schema, schema)
+        prefix_items = day_schema.get("prefixItems", [])
+        count = day_schema.get("maxItems", day_schema.get("minItems", len(prefix_items)))
+        slots = []
+        for i in range(count):
+            slot_schema = _resolve(prefix_items[i] if i < len(prefix_items) else day_schema.get("items", {}), schema)
+            slots.append([tuple(pair) for pair in slot_schema.get("enum", [])])
+        days.append(slots)
+    return days
+
+
+def _gain(contributions, week_activation: Dict, day_activation: Dict) -> float:
+    gain = 0.0
+    for key, score in contributions:
+        weight = MUSCLE_IMPORTANCE[key]
+        week_total = week_activation.get(key, 0)
+        day_total = day_activation.get(key, 0)
+        gain += weight * (min(week_total + score, COVERAGE_TARGET) - min(week_total, COVERAGE_TARGET))
+        gain += DAY_COVERAGE_WEIGHT * weight * (min(day_total + score, COVERAGE_TARGET) - min(day_total, COVERAGE_TARGET))
+    return gain
+
+
+def solve_week(day_slots: List[List[List[Pair]]], exercise_map: Mapping[str, Mapping], contributions: Mapping[str, tuple],
+               rng: Optional[random.Random] = None, prevent_weekly_duplicates: bool = True, prevent_category_duplicates: bool = True) -> dict:
+    """Fills every slot with the allowed exercise that adds the most importance-weighted muscle coverage.
+
+    Greedy marginal-gain selection: no exercise repeats within the week and no category repeats within
+    a day (UNCATEGORIZED excepted). Those rules are relaxed, category first, only when a slot has no
+    other candidate. Ties are broken by shuffling each slot's candidates with `rng`.
+    """
+    rng = rng or random.Random()
+    week_activation: Dict = {}
+    used_in_week = set()
+    days = []
+
+    for slots in day_slots:
+        day_activation: Dict = {}
+        used_today = set()
+        categories_today = set()
+        day = []
+        for candidates in slots:
+            candidates = [pair for pair in candidates if pair[1] in exercise_map and pair[1] not in used_today]
+            rng.shuffle(candidates)
+
+            def category_free(pair):
+                category = exercise_map[pair[1]].get('category')
+                return not category or category == UNCATEGORIZED or category not in categories_today
+
+            def week_free(pair):
+                return pair[1] not in used_in_week
+
+            rule_sets = [
+                [check for check, enabled in ((week_free, prevent_weekly_duplicates), (category_free, prevent_category_duplicates)) if enabled],
+                [week_free] if prevent_weekly_duplicates else [],
+                [],
+            ]
+            pool = []
+            for rules in rule_sets:
+                pool = [pair for pair in candidates if all(rule(pair) for rule in rules)]
+                if pool:
+                    break
+            if not pool:
+                continue
+
+            # max() keeps the first of equal gains, so the shuffle decides ties
+            bp, name = max(pool, key=lambda pair: _gain(contributions.get(pair[1], ()), week_activation, day_activation))
+            for key, score in contributions.get(name, ()):
+                week_activation[key] = week_activation.get(key, 0) + score
+                day_activation[key] = day_activation.get(key, 0) + score
+            day.append([bp, name])
+            used_today.add(name)
+            used_in_week.add(name)
+            category = exercise_map[name].get('category')
+            if category:
+                categories_today.add(category)
+        days.append(day)
+
+    return {"days": days}
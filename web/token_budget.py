@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import math
+import re
+import time
+from typing import Dict, Iterable, List, Optional
+
+import httpx
+
+_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+_DIGIT_RUN_PATTERN = re.compile(r"\d|\D+")
+
+
+def _estimate_tokens(text: str) -> int:
+    # Deliberately high: one token per punctuation mark, per digit (Gemma splits numbers into
+    # single digits), per 4 other ASCII word characters and per non-ASCII character.
+    # Whitespace is assumed to merge into the following word.
+    count = 0
+    for piece in _PIECE_PATTERN.findall(text):
+        if not piece[0].isalnum() and piece[0] != '_':
+            count += 1
+        elif piece.isascii():
+            count += sum(1 if run.isdigit() else math.ceil(len(run) / 4) for run in _DIGIT_RUN_PATTERN.findall(piece))
+        else:
+            count += len(piece)
+    return count
+
+
+class TokenCounter:
+    """Token counts from the served model's tokenizer, through vLLM's /tokenize endpoint.
+
+    fetch() asks vLLM for the counts it does not have yet, concurrently and without blocking the
+    event loop; counts are memoized since schemas repeat the same enum values. count() never does
+    I/O: it returns a fetched count or, for text not fetched, the estimate. After a failed fetch the
+    endpoint is retried once `retry_interval` seconds have passed.
+    """
+
+    def __init__(self, model: Optional[str], tokenize_url: Optional[str], timeout: float = 5.0,
+                 concurrency: int = 16, retry_interval: float = 30.0):
+        self.model = model
+        self.tokenize_url = tokenize_url
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.retry_interval = retry_interval
+        self._http: Optional[httpx.AsyncClient] = None
+        self._counts: Dict[str, int] = {}
+        self._retry_at = 0.0
+        self.load_error: Optional[str] = None
+
+    @property
+    def backend(self) -> str:
+        return f"vllm:{self.tokenize_url}" if self.tokenize_url else "estimate"
+
+    @property
+    def available(self) -> bool:
+        """False while the endpoint is unset or backing off after a failure."""
+        return bool(self.tokenize_url) and time.monotonic() >= self._retry_at
+
+    def is_exact(self, text: str) -> bool:
+        return text in self._counts
+
+    def count(self, text: str) -> int:
+        cached = self._counts.get(text)
+        return cached if cached is not None else _estimate_tokens(text)
+
+    async def fetch(self, texts: Iterable[str]) -> bool:
+        """Fetches the counts missing for `texts`; True when every one of them is now exact."""
+        missing = [text for text in dict.fromkeys(texts) if text not in self._counts]
+        if not missing:
+            return True
+        if not self.available:
+            return False
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=self.timeout)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_one(text: str):
+            async with semaphore:
+                resp = await self._http.post(self.tokenize_url, json={"model": self.model, "prompt": text, "add_special_tokens": False})
+            resp.raise_for_status()
+            self._counts[text] = int(resp.json()["count"])
+
+        results = await asyncio.gather(*(fetch_one(text) for text in missing), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            # Counts that did arrive are kept; the rest are retried after the backoff
+            self.load_error = f"{type(errors[0]).__name__}: {errors[0]}"
+            self._retry_at = time.monotonic() + self.retry_interval
+            return False
+        self.load_error = None
+        return True
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def _resolve_ref(ref: str, root: dict):
+    node = root
+    for part in ref.lstrip('#').strip('/').split('/'):
+        node = node[part]
+    return node
+
+
+def schema_texts(node, texts: Optional[List[str]] = None) -> List[str]:
+    """Every enum value, const and property name max_output_tokens counts, as the text it counts."""
+    if texts is None:
+        texts = []
+    if isinstance(node, dict):
+        if isinstance(node.get("enum"), list):
+            texts.extend(_dumps(value) for value in node["enum"])
+        if "const" in node:
+            texts.append(_dumps(node["const"]))
+        if node.get("type") == "object":
+            texts.extend(_dumps(key) for key in node.get("properties", {}))
+        for key, value in node.items():
+            if key not in ("enum", "const"):
+                schema_texts(value, texts)
+    elif isinstance(node, list):
+        for item in node:
+            schema_texts(item, texts)
+    return texts
+
+
+def max_output_tokens(node, counter: TokenCounter, root: Optional[dict] = None, whitespace: int = 0, _ref_bounds: Optional[dict] = None) -> Optional[int]:
+    """Upper bound on the tokens of any JSON value the schema accepts, or None if unbounded.
+
+    Enum values are counted whole; every bracket, comma and colon around them counts as one token plus
+    `whitespace` tokens for whitespace next to it (the guided grammar allows whitespace between any two
+    elements; 0 bounds minified output only). Only the subset of JSON Schema used by the week schemas
+    is understood; local $refs resolve against `root` (the node itself by default) and each one is
+    bounded only once.
+    """
+    if root is None:
+        root = node
+    if _ref_bounds is None:
+        _ref_bounds = {}
+    if node is False:
+        return 0
+    if not isinstance(node, dict):
+        return None
+    if "$ref" in node:
+        ref = node["$ref"]
+        if ref not in _ref_bounds:
+            _ref_bounds[ref] = max_output_tokens(_resolve_ref(ref, root), counter, root, whitespace, _ref_bounds)
+        return _ref_bounds[ref]
+    if "enum" in node:
+        return max((counter.count(_dumps(value)) for value in node["enum"]), default=0)
+    if "const" in node:
+        return counter.count(_dumps(node["const"]))
+
+    separator = 1 + whitespace
+    node_type = node.get("type")
+    if node_type == "array":
+        max_items = node.get("maxItems")
+        if max_items is None:
+            return None
+        prefix_items = node.get("prefixItems", [])
+        total = separator * (2 + max(max_items - 1, 0))
+        for i in range(max_items):
+            item_bound = max_output_tokens(prefix_items[i] if i < len(prefix_items) else node.get("items", {}), counter, root, whitespace, _ref_bounds)
+            if item_bound is None:
+                return None
+            total += item_bound
+        return total
+    if node_type == "object":
+        # Assumes the model emits only the declared properties, as guided decoding enforces here
+        properties = node.get("properties", {})
+        total = separator * (2 + max(len(properties) - 1, 0))
+        for key, sub_schema in properties.items():
+            value_bound = max_output_tokens(sub_schema, counter, root, whitespace, _ref_bounds)
+            if value_bound is None:
+                return None
+            total += counter.count(_dumps(key)) + separator + value_bound
+        return total
+    return None
+
+
+def schema_token_budget(schema: dict, counter: TokenCounter, margin: float = 1.1, slack: int = 16, whitespace: int = 1) -> Optional[int]:
+    """max_tokens for a guided generation: the schema's output bound with a safety margin.
+
+    `whitespace` tokens are allowed next to every bracket, comma and colon, so output like
+    `[["Chest", 12], ...]` fits as well as minified JSON; `slack` covers the end-of-sequence token.
+    """
+    bound = max_output_tokens(schema, counter, whitespace=whitespace)
+    if bound is None:
+        return None
+    return math.ceil(bound * margin) + slack
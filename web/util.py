@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
-from .prompts import common_prompt, SPLIT_RULES, LEVEL_GUIDE
+from .prompts import common_prompt, prefix_cache_prompt, CATALOG_FORMATS, OUTPUT_FORMATS, SPLIT_RULES, LEVEL_GUIDE
 import random
 import json
 import re
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from typing import Dict, List, Tuple, Optional
 
 import os
 
@@ -191,11 +192,15 @@ def _group_catalog_by_split(catalog: list, split_days: List[str]) -> Dict[str, l
 
     return grouped_catalog
 
-def _apply_special_ordering(grouped_catalog: Dict[str, list], split_days: List[str]):
+def _apply_special_ordering(grouped_catalog: Dict[str, list], split_days: List[str], rng=random, deterministic: bool = False):
     ## 특별 순서 적용
-    """Applies special ordering for 2 and 3-day splits."""
-    for group_list in grouped_catalog.values():
-        random.shuffle(group_list)
+    """Applies special ordering for 2 and 3-day splits.
+
+    With deterministic=True the catalog keeps its source order and no randomness is used.
+    """
+    if not deterministic:
+        for group_list in grouped_catalog.values():
+            rng.shuffle(group_list)
 
     def get_ordered_list(exercises, order):
         sub_groups = {key: [] for key in order}
@@ -215,7 +220,7 @@ def _apply_special_ordering(grouped_catalog: Dict[str, list], split_days: List[s
 
     if not is_full_body_split:
         if freq == 2 and 'UPPER' in grouped_catalog:
-            chest_back_order = ['CHEST', 'BACK'] if random.random() < 0.5 else ['BACK', 'CHEST']
+            chest_back_order = ['CHEST', 'BACK'] if deterministic or rng.random() < 0.5 else ['BACK', 'CHEST']
             upper_order = chest_back_order + ['SHOULDER', 'ARM']
             grouped_catalog['UPPER'] = get_ordered_list(grouped_catalog['UPPER'], upper_order)
 
@@ -227,79 +232,242 @@ def _apply_special_ordering(grouped_catalog: Dict[str, list], split_days: List[s
     
     return grouped_catalog
 
-def _build_catalog_string(grouped_catalog: Dict[str, list], split_days: List[str], catalog: list) -> str:
+def _build_catalog_fragments(grouped_catalog: Dict[str, list], catalog: list) -> Dict[str, list]:
+    ## 카탈로그 조각 생성
+    """Renders each grouped exercise once into a (bName, category, line) fragment."""
+    eName_to_tool_map = {item.get('eName'): item.get('tool_en', 'Etc') for item in catalog}
+    fragments = {}
+    for day, exercises in grouped_catalog.items():
+        day_fragments = []
+        for exercise in exercises:
+            bName, eName, category, mg_num, muscle_group, is_main = exercise
+            tool = eName_to_tool_map.get(eName, 'Etc')
+            display_bName = f"{bName} (main)" if is_main else bName
+            prompt_item = [display_bName, eName, tool, mg_num, muscle_group]
+            day_fragments.append((bName, category if category else "(Uncategorized)", json.dumps(prompt_item, ensure_ascii=False)))
+        fragments[day] = day_fragments
+    return fragments
+
+# --- Compact catalog encoding ---
+
+@dataclass(frozen=True)
+class CatalogCodes:
+    """Short codes used by the compact catalog encoding, built once from the full catalog."""
+    exercise_ids: Dict[str, int]  # eName -> integer ID the model answers with
+    tool_codes: Dict[str, str]
+    muscle_codes: Dict[str, str]
+
+    @property
+    def names_by_id(self) -> Dict[int, str]:
+        return {exercise_id: name for name, exercise_id in self.exercise_ids.items()}
+
+    def legend(self) -> dict:
+        return {
+            "tool_legend": ", ".join(f"{code}={name}" for name, code in self.tool_codes.items()),
+            "muscle_legend": ", ".join(f"{code}={name}" for name, code in self.muscle_codes.items()),
+        }
+
+def _short_codes(names) -> Dict[str, str]:
+    """Assigns each name a short uppercase code from its initials or leading letters.
+
+    On a collision the leading word is spelled out further; numbering is the last resort.
+    """
+    codes = {}
+    taken = set()
+    for name in sorted(set(names)):
+        words = re.findall(r"[A-Za-z]+", name) or ["X"]
+        rest = "".join(w[0] for w in words[1:])
+        candidates = [words[0][:length] + rest for length in range(1 if rest else 2, len(words[0]) + 1)]
+        base = candidates[0].upper()
+        code = next((c.upper() for c in candidates if c.upper() not in taken), None)
+        n = 2
+        while code is None or code in taken:
+            code, n = f"{base}{n}", n + 1
+        taken.add(code)
+        codes[name] = code
+    return codes
+
+def build_catalog_codes(catalog: list) -> CatalogCodes:
+    names = sorted({item.get('eName') for item in catalog if item.get('eName')})
+    muscle_parts = []
+    for item in catalog:
+        mg = item.get('MG')
+        if isinstance(mg, str) and mg.strip():
+            muscle_parts.extend(p.strip() for p in mg.split('/') if p.strip())
+    return CatalogCodes(
+        exercise_ids={name: i for i, name in enumerate(names, start=1)},
+        tool_codes=_short_codes(item.get('tool_en', 'Etc') for item in catalog),
+        muscle_codes=_short_codes(muscle_parts),
+    )
+
+_MICRO_PART_PATTERN = re.compile(r"^(.*?)\((\d+)\)$")
+
+def _build_compact_fragments(grouped_catalog: Dict[str, list], catalog: list, codes: CatalogCodes) -> Dict[str, list]:
+    """Renders each grouped exercise once as a compact `ID|eName|tool|muscles` fragment."""
+    eName_to_tool_map = {item.get('eName'): item.get('tool_en', 'Etc') for item in catalog}
+    fragments = {}
+    for day, exercises in grouped_catalog.items():
+        day_fragments = []
+        for exercise in exercises:
+            bName, eName, category, mg_num, muscle_group, is_main = exercise
+            muscles = []
+            for part in muscle_group["micro"]:
+                match = _MICRO_PART_PATTERN.match(part)
+                name, score = (match.group(1), match.group(2)) if match else (part, "")
+                muscles.append(codes.muscle_codes.get(name, name) + score)
+            tool = eName_to_tool_map.get(eName, 'Etc')
+            marker = "*" if is_main else ""
+            line = f"{codes.exercise_ids.get(eName, eName)}{marker}|{eName}|{codes.tool_codes.get(tool, tool)}|{','.join(muscles)}"
+            day_fragments.append((bName, category if category else "(Uncategorized)", line))
+        fragments[day] = day_fragments
+    return fragments
+
+def _append_compact_lines(catalog_lines: List[str], fragments: list):
+    # Body parts keep the order set by _apply_special_ordering; categories are sorted within each
+    body_parts = {}
+    for bName, category, line in fragments:
+        body_parts.setdefault(bName, {}).setdefault(category, []).append(line)
+
+    for bName, category_groups in body_parts.items():
+        catalog_lines.append(f" {bName}")
+        for category in sorted(category_groups.keys()):
+            catalog_lines.append(f"  {category}: " + "; ".join(category_groups[category]))
+
+def _append_category_lines(catalog_lines: List[str], fragments: list):
+    category_groups = {}
+    for _, category, line in fragments:
+        if category not in category_groups:
+            category_groups[category] = []
+        category_groups[category].append(line)
+
+    for category in sorted(category_groups.keys()):
+        cat_lines = category_groups[category]
+        catalog_lines.append(f"  {category}:")
+        for i, line in enumerate(cat_lines):
+            line_end = "," if i < len(cat_lines) - 1 else ""
+            catalog_lines.append("    " + line + line_end)
+
+def _build_catalog_string(grouped_fragments: Dict[str, list], split_days: List[str], append_lines=_append_category_lines) -> str:
     ## 카탈로그 문자열 생성
     """Builds the final catalog string for the prompt with nested grouping."""
     catalog_lines = []
-    eName_to_tool_map = {item.get('eName'): item.get('tool_en', 'Etc') for item in catalog}
     is_full_body_split = any(day.startswith("FULLBODY") for day in split_days)
 
     if is_full_body_split:
         # For full body, print a single unified catalog
         catalog_lines.append("FULL BODY (All exercises available for all days)")
-        exercises_for_day = grouped_catalog.get("FULLBODY", [])
-        if exercises_for_day:
-            category_groups = {}
-            for exercise in exercises_for_day:
-                category = exercise[2] if exercise[2] else "(Uncategorized)"
-                if category not in category_groups:
-                    category_groups[category] = []
-                category_groups[category].append(exercise)
-
-            for category in sorted(category_groups.keys()):
-                cat_exercises = category_groups[category]
-                catalog_lines.append(f"  {category}:")
-                for i, exercise in enumerate(cat_exercises):
-                    tool = eName_to_tool_map.get(exercise[1], 'Etc')
-                    line_end = "," if i < len(cat_exercises) - 1 else ""
-                    bName = exercise[0]
-                    eName = exercise[1]
-                    is_main = exercise[5]
-                    display_bName = f"{bName} (main)" if is_main else bName
-                    prompt_item = [display_bName, eName, tool, exercise[3], exercise[4]]
-                    catalog_lines.append("    " + json.dumps(prompt_item, ensure_ascii=False) + line_end)
+        append_lines(catalog_lines, grouped_fragments.get("FULLBODY", []))
     else:
-        # Existing logic for split workouts
         for day in split_days:
             muscle_group_info = SPLIT_MUSCLE_GROUPS.get(day, "")
             catalog_lines.append(f"{day} {muscle_group_info}".strip())
-            exercises_for_day = grouped_catalog.get(day, [])
-
-            if exercises_for_day:
-                category_groups = {}
-                for exercise in exercises_for_day:
-                    category = exercise[2] if exercise[2] else "(Uncategorized)"
-                    if category not in category_groups:
-                        category_groups[category] = []
-                    category_groups[category].append(exercise)
-
-                for category in sorted(category_groups.keys()):
-                    cat_exercises = category_groups[category]
-                    catalog_lines.append(f"  {category}:")
-                    for i, exercise in enumerate(cat_exercises):
-                        tool = eName_to_tool_map.get(exercise[1], 'Etc')
-                        line_end = "," if i < len(cat_exercises) - 1 else ""
-                        bName = exercise[0]
-                        eName = exercise[1]
-                        is_main = exercise[5]
-                        display_bName = f"{bName} (main)" if is_main else bName
-                        prompt_item = [display_bName, eName, tool, exercise[3], exercise[4]]
-                        catalog_lines.append("    " + json.dumps(prompt_item, ensure_ascii=False) + line_end)
+            append_lines(catalog_lines, grouped_fragments.get(day, []))
 
     return "\n".join(catalog_lines)
 
-def build_prompt(user: User, catalog: list, duration_str: str, min_ex: int, max_ex: int, split_config: dict, allowed_names: dict = None) -> str:
+class CatalogFragmentCache:
+    """LRU cache of rendered catalog fragments, keyed by the inputs that change the catalog section.
+
+    Only filtering, grouping and rendering are cached; the per-request shuffle is applied to a
+    copy of the cached fragment lists, so prompts keep their randomized ordering.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, user: User, catalog: list, split_days: List[str], allowed_names: dict, codes: Optional[CatalogCodes] = None) -> Dict[str, list]:
+        """Returns JSON fragments, or compact fragments when codes are given."""
+        tools_key = frozenset(t.lower() for t in user.tools) if user.tools else frozenset()
+        key = (user.gender, user.level, tuple(split_days), tools_key, id(catalog), id(allowed_names), id(codes))
+        entry = self._entries.get(key)
+        # The entry keeps its catalog, allowed_names and codes alive, so a matching id() is the same object
+        if entry is not None and entry[0] is catalog and entry[1] is allowed_names and entry[2] is codes:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[3]
+
+        self.misses += 1
+        filtered_catalog = _filter_catalog(catalog, user, allowed_names)
+        grouped_catalog = _group_catalog_by_split(filtered_catalog, split_days)
+        if codes is None:
+            fragments = _build_catalog_fragments(grouped_catalog, filtered_catalog)
+        else:
+            fragments = _build_compact_fragments(grouped_catalog, filtered_catalog, codes)
+        self._entries[key] = (catalog, allowed_names, codes, fragments)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return fragments
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+CATALOG_FRAGMENT_CACHE = CatalogFragmentCache(maxsize=int(os.getenv("PROMPT_CACHE_SIZE", "1024")))
+
+# --- Prompt layouts ---
+# "default" is the layout the model was fine-tuned on. "prefix_cache" moves the user-specific
+# fields to the end and renders the catalog in a fixed order, so requests that share a split
+# and equipment share a long prompt prefix in vLLM's automatic prefix cache.
+PROMPT_LAYOUTS = {
+    "default": common_prompt,
+    "prefix_cache": prefix_cache_prompt,
+}
+DEFAULT_PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "default")
+if DEFAULT_PROMPT_LAYOUT not in PROMPT_LAYOUTS:
+    raise ValueError(f"Unknown PROMPT_LAYOUT {DEFAULT_PROMPT_LAYOUT!r}; expected one of {sorted(PROMPT_LAYOUTS)}")
+
+# "json" renders one JSON array per exercise and the model answers with exercise names.
+# "compact" renders integer IDs with tool/muscle codes and category headers, and the model
+# answers with IDs that the server maps back to names.
+DEFAULT_CATALOG_ENCODING = os.getenv("PROMPT_CATALOG_ENCODING", "json")
+if DEFAULT_CATALOG_ENCODING not in CATALOG_FORMATS:
+    raise ValueError(f"Unknown PROMPT_CATALOG_ENCODING {DEFAULT_CATALOG_ENCODING!r}; expected one of {sorted(CATALOG_FORMATS)}")
+
+def build_prompt(user: User, catalog: list, duration_str: str, min_ex: int, max_ex: int, split_config: dict, allowed_names: dict = None, rng: Optional[random.Random] = None, layout: Optional[str] = None, catalog_encoding: Optional[str] = None, codes: Optional[CatalogCodes] = None, output_format: str = "pairs") -> str:
     ## 프롬프트 생성
-    prompt_template = common_prompt
+    """Builds the generation prompt. The compact catalog encoding uses `codes`, built from `catalog` if omitted.
+
+    output_format="ids" asks for bare exercise IDs instead of [bodypart, ID] pairs and needs the compact encoding.
+    """
+    layout = layout or DEFAULT_PROMPT_LAYOUT
+    prompt_template = PROMPT_LAYOUTS[layout]
+    catalog_encoding = catalog_encoding or DEFAULT_CATALOG_ENCODING
+    if output_format == "ids" and catalog_encoding != "compact":
+        raise ValueError("output_format 'ids' requires the compact catalog encoding")
+    if catalog_encoding == "compact":
+        codes = codes or build_catalog_codes(catalog)
+        catalog_format = CATALOG_FORMATS["compact"].format(**codes.legend())
+        append_lines = _append_compact_lines
+    else:
+        codes = None
+        catalog_format = CATALOG_FORMATS["json"]
+        append_lines = _append_category_lines
 
     split_days = split_config["days"]
     split_name = split_config["name"]
     rule_key = split_config["rule_key"]
 
-    filtered_catalog = _filter_catalog(catalog, user, allowed_names)
-    grouped_catalog = _group_catalog_by_split(filtered_catalog, split_days)
-    ordered_grouped_catalog = _apply_special_ordering(grouped_catalog, split_days)
-    catalog_str = _build_catalog_string(ordered_grouped_catalog, split_days, filtered_catalog)
+    cached_fragments = CATALOG_FRAGMENT_CACHE.get(user, catalog, split_days, allowed_names, codes)
+    grouped_fragments = {day: list(fragments) for day, fragments in cached_fragments.items()}
+    ordered_grouped_fragments = _apply_special_ordering(
+        grouped_fragments, split_days, rng=rng or random, deterministic=(layout == "prefix_cache")
+    )
+    catalog_str = _build_catalog_string(ordered_grouped_fragments, split_days, append_lines)
 
     split_rules = SPLIT_RULES.get(rule_key, "")
     level_guide = LEVEL_GUIDE.get(user.level, "")
@@ -315,7 +483,9 @@ def build_prompt(user: User, catalog: list, duration_str: str, min_ex: int, max_
         split_days=" / ".join(split_days),
         level_guide=level_guide,
         split_rules=split_rules,
-        catalog_json=catalog_str
+        catalog_format=catalog_format,
+        catalog_json=catalog_str,
+        output_format=OUTPUT_FORMATS["compact_ids" if output_format == "ids" else catalog_encoding],
     )
 
 def format_new_routine(plan_json: dict, name_map: dict, enable_sorting: bool = False, show_b_name: bool = True) -> str: